@@ -1,19 +1,45 @@
 import click
 import time
 import sys
+import csv
+import json
 from datetime import date
 from collections import OrderedDict
 from operator import itemgetter
 
 from cas_admin.query_utils import query_account, get_account_data, get_charge_data
+from cas_admin.bulk_utils import BulkWriter, update_accounts
+from cas_admin.snapshots import SnapshotStore
 import cas_admin.cost_functions as cost_functions
 
 # Account types must match the names of cost functions
 ACCOUNT_TYPES = [x for x in dir(cost_functions) if not x.startswith("_")]
 
 
-def display_account(es_client, account, index="cas-credit-accounts"):
-    """Displays account info"""
+def update_account(
+    es_client, account, account_hit, update, index="cas-credit-accounts"
+):
+    """Applies a partial update to an account given its search hit"""
+
+    doc_id = account_hit["_id"]
+    success_count, errors = update_accounts(
+        es_client,
+        index,
+        {doc_id: update},
+        versions={doc_id: (account_hit["_seq_no"], account_hit["_primary_term"])},
+    )
+    if len(errors) > 0:
+        click.echo(
+            f"ERROR: Failed to update account {account} in index {index}: {errors[doc_id]}",
+            err=True,
+        )
+        sys.exit(1)
+
+
+def display_account(
+    es_client, account, index="cas-credit-accounts", as_of=None, snapshot_dir=None
+):
+    """Displays account info (as of a past date from daily snapshots)"""
 
     columns = OrderedDict()
     columns["account_id"] = "Account Name"
@@ -50,9 +76,15 @@ def display_account(es_client, account, index="cas-credit-accounts"):
         "percent_gpu_credits_used",
     }
 
-    account_data = get_account_data(
-        es_client, account=account, addl_cols=addl_cols, index=index
-    )
+    if as_of is None:
+        account_data = get_account_data(
+            es_client, account=account, addl_cols=addl_cols, index=index
+        )
+    else:
+        account_data = SnapshotStore(snapshot_dir, read_only=True).get_account_data(
+            as_of, account=account, addl_cols=addl_cols
+        )
+        index = f"{snapshot_dir} as of {as_of}"
 
     if len(account_data) == 0:
         click.echo(f"ERROR: No account '{account}' found in index '{index}'", err=True)
@@ -76,9 +108,14 @@ def display_account(es_client, account, index="cas-credit-accounts"):
 
 
 def display_all_accounts(
-    es_client, sort_col="account_id", sort_reverse=False, index="cas-credit-accounts"
+    es_client,
+    sort_col="account_id",
+    sort_reverse=False,
+    index="cas-credit-accounts",
+    as_of=None,
+    snapshot_dir=None,
 ):
-    """Displays all accounts info"""
+    """Displays all accounts info (as of a past date from daily snapshots)"""
 
     columns = OrderedDict()
     columns["account_id"] = "Name"
@@ -114,7 +151,13 @@ def display_all_accounts(
         "percent_gpu_credits_used",
     }
 
-    account_data = get_account_data(es_client, addl_cols=addl_cols, index=index)
+    if as_of is None:
+        account_data = get_account_data(es_client, addl_cols=addl_cols, index=index)
+    else:
+        account_data = SnapshotStore(snapshot_dir, read_only=True).get_account_data(
+            as_of, addl_cols=addl_cols
+        )
+        index = f"{snapshot_dir} as of {as_of}"
     if len(account_data) == 0:
         click.echo(f"ERROR: No accounts found in index '{index}'", err=True)
         sys.exit(1)
@@ -163,6 +206,84 @@ def display_all_accounts(
         click.echo(" ".join(items))
 
 
+def display_account_balances(account, start_date, end_date, snapshot_dir):
+    """Displays an account's daily credits and charges from snapshots"""
+
+    columns = OrderedDict()
+    columns["date"] = "Date"
+    columns["cpu_credits"] = "CpuCredits"
+    columns["cpu_charges"] = "CpuCharges"
+    columns["remaining_cpu_credits"] = "CpuRemain"
+    columns["gpu_credits"] = "GpuCredits"
+    columns["gpu_charges"] = "GpuCharges"
+    columns["remaining_gpu_credits"] = "GpuRemain"
+
+    addl_cols = ["remaining_cpu_credits", "remaining_gpu_credits"]
+
+    snapshot_store = SnapshotStore(snapshot_dir, read_only=True)
+    rows = []
+    for this_date, row in snapshot_store.iter_account_history(
+        account, start_date, end_date, addl_cols
+    ):
+        if row is None:
+            continue
+        row["date"] = str(this_date)
+        rows.append(row)
+    if len(rows) == 0:
+        click.echo(
+            f"ERROR: No snapshots of account '{account}' found in {snapshot_dir} from {start_date} to {end_date}",
+            err=True,
+        )
+        sys.exit(1)
+
+    col_size = {col: max(len(col_name), 10) for col, col_name in columns.items()}
+    for row in rows:
+        for col in columns:
+            if col != "date":
+                col_size[col] = max(col_size[col], len(f"{row.get(col, 0):,.1f}"))
+
+    items = [columns["date"].ljust(col_size["date"])]
+    for col, col_name in columns.items():
+        if col != "date":
+            items.append(col_name.rjust(col_size[col]))
+    click.echo(" ".join(items))
+    for row in rows:
+        items = [row["date"].ljust(col_size["date"])]
+        for col in columns:
+            if col != "date":
+                items.append(f"{row.get(col, 0):,.1f}".rjust(col_size[col]))
+        click.echo(" ".join(items))
+
+
+def get_new_account_info(
+    account,
+    owner,
+    email,
+    project,
+    cpu_function,
+    gpu_function,
+    cpu_credts=0,
+    gpu_credts=0,
+):
+    """Returns the doc of a new account"""
+
+    return {
+        "account_id": account,
+        "owner": owner,
+        "owner_email": email,
+        "owner_project": project,
+        "cpu_charge_function": cpu_function,
+        "cpu_credits": cpu_credts,
+        "cpu_charges": 0,
+        "cpu_last_credit_date": str(date.today()),
+        "gpu_charge_function": gpu_function,
+        "gpu_credits": gpu_credts,
+        "gpu_charges": 0,
+        "gpu_last_credit_date": str(date.today()),
+        "cas_version": "v2",
+    }
+
+
 def add_account(
     es_client,
     account,
@@ -195,21 +316,16 @@ def add_account(
         sys.exit(1)
 
     # Create account obj
-    account_info = {
-        "account_id": account,
-        "owner": owner,
-        "owner_email": email,
-        "owner_project": project,
-        "cpu_charge_function": cpu_function,
-        "cpu_credits": cpu_credts,
-        "cpu_charges": 0,
-        "cpu_last_credit_date": str(date.today()),
-        "gpu_charge_function": gpu_function,
-        "gpu_credits": gpu_credts,
-        "gpu_charges": 0,
-        "gpu_last_credit_date": str(date.today()),
-        "cas_version": "v2",
-    }
+    account_info = get_new_account_info(
+        account,
+        owner,
+        email,
+        project,
+        cpu_function,
+        gpu_function,
+        cpu_credts,
+        gpu_credts,
+    )
     doc_id = account
 
     # Upload account
@@ -217,6 +333,148 @@ def add_account(
     click.echo(f"account {account} added.")
 
 
+def read_rows_file(rows_file):
+    """Returns rows of a CSV (.csv) or newline-delimited JSON file as dicts"""
+
+    with rows_file.open() as f:
+        if rows_file.suffix.casefold() == ".csv":
+            return list(csv.DictReader(f))
+        rows = []
+        row_errors = {}
+        for i_line, line in enumerate(f, start=1):
+            if line.strip() == "":
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                click.echo(
+                    f"ERROR: Invalid JSON on line {i_line} of {rows_file}: {e}",
+                    err=True,
+                )
+                sys.exit(1)
+            rows.append(row)
+            if not isinstance(row, dict):
+                row_errors[len(rows)] = f"Not a JSON object on line {i_line}: {row}"
+        if len(row_errors) > 0:
+            echo_row_errors(row_errors, rows_file)
+        return rows
+
+
+def get_existing_account_ids(es_client, accounts, index="cas-credit-accounts"):
+    """Returns the (seq_no, primary_term) of the given accounts that exist,
+    looked up in one request"""
+
+    if len(accounts) == 0:
+        return {}
+    docs = es_client.mget(index=index, body={"ids": list(accounts)}, _source=False)
+    return {
+        doc["_id"]: (doc["_seq_no"], doc["_primary_term"])
+        for doc in docs["docs"]
+        if doc.get("found", False)
+    }
+
+
+def echo_row_errors(row_errors, rows_file):
+    """Prints per-row validation errors and exits"""
+
+    for i_row, error in sorted(row_errors.items()):
+        click.echo(f"ERROR: Row {i_row}: {error}", err=True)
+    click.echo(
+        f"ERROR: {len(row_errors)} invalid rows in {rows_file}, no changes made",
+        err=True,
+    )
+    sys.exit(1)
+
+
+def add_accounts_from_file(es_client, rows_file, index="cas-credit-accounts"):
+    """Adds accounts from a CSV or NDJSON file with account, owner, email,
+    and optional project, cpu_function, gpu_function, cpu_credits, and
+    gpu_credits columns. Every row is validated and checked against
+    existing accounts before all accounts are created in one bulk request."""
+
+    rows = read_rows_file(rows_file)
+
+    # Check input
+    row_errors = {}
+    account_infos = {}
+    account_rows = {}
+    for i_row, row in enumerate(rows, start=1):
+        account = str(row.get("account") or "").strip()
+        owner = str(row.get("owner") or "").strip()
+        email = str(row.get("email") or "").strip()
+        project = str(row.get("project") or "").strip()
+        cpu_function = str(row.get("cpu_function") or "cpu_2022").strip()
+        gpu_function = str(row.get("gpu_function") or "gpu_2022").strip()
+        if account == "":
+            row_errors[i_row] = "Missing account"
+            continue
+        if account in account_rows:
+            row_errors[i_row] = (
+                f"Duplicate account {account} (row {account_rows[account]})"
+            )
+            continue
+        if owner == "" or email == "":
+            row_errors[i_row] = f"Missing owner or email for account {account}"
+            continue
+        if not cpu_function.startswith("cpu") or cpu_function not in ACCOUNT_TYPES:
+            row_errors[i_row] = f"Unknown CPU function {cpu_function}"
+            continue
+        if not gpu_function.startswith("gpu") or gpu_function not in ACCOUNT_TYPES:
+            row_errors[i_row] = f"Unknown GPU function {gpu_function}"
+            continue
+        try:
+            cpu_credts = float(row.get("cpu_credits") or 0)
+            gpu_credts = float(row.get("gpu_credits") or 0)
+        except ValueError:
+            row_errors[i_row] = f"Non-numeric credits provided for account {account}"
+            continue
+        account_rows[account] = i_row
+        account_infos[account] = get_new_account_info(
+            account,
+            owner,
+            email,
+            project,
+            cpu_function,
+            gpu_function,
+            cpu_credts,
+            gpu_credts,
+        )
+
+    # Check existing
+    for account in get_existing_account_ids(es_client, account_infos, index):
+        row_errors[account_rows[account]] = (
+            f"Existing account {account} already found in index {index}"
+        )
+    if len(row_errors) > 0:
+        echo_row_errors(row_errors, rows_file)
+
+    # Upload accounts
+    writer = BulkWriter(es_client)
+    for account, account_info in account_infos.items():
+        writer.add(
+            account,
+            {
+                "_op_type": "create",
+                "_index": index,
+                "_id": account,
+                "_source": account_info,
+            },
+        )
+    success_count, errors = writer.close()
+
+    for account, i_row in account_rows.items():
+        if account in errors:
+            click.echo(
+                f"ERROR: Row {i_row}: Failed to add account {account}: {errors[account]}",
+                err=True,
+            )
+        else:
+            click.echo(f"Row {i_row}: account {account} added.")
+    click.echo(f"{success_count} of {len(account_rows)} accounts added.")
+    if len(errors) > 0:
+        sys.exit(1)
+
+
 def edit_owner(
     es_client, account, name=None, email=None, project=None, index="cas-credit-accounts"
 ):
@@ -279,17 +537,85 @@ def add_credits(es_client, account, credt_type, credts, index="cas-credit-accoun
         )
         sys.exit(1)
 
-    # Update account obj
-    doc_id = existing_account_results["hits"]["hits"][0]["_id"]
-    account_info = existing_account_results["hits"]["hits"][0]["_source"]
-    account_info[f"{credt_type}_credits"] += credts
-    account_info[f"{credt_type}_last_credit_date"] = str(date.today())
-
-    # Upload account
-    es_client.index(index=index, id=doc_id, body=account_info)
+    # Update account
+    update_account(
+        es_client,
+        account,
+        existing_account_results["hits"]["hits"][0],
+        {
+            "increments": {f"{credt_type}_credits": credts},
+            "sets": {f"{credt_type}_last_credit_date": str(date.today())},
+        },
+        index,
+    )
     click.echo(f"Account {account} updated.")
 
 
+def add_credits_from_file(es_client, rows_file, index="cas-credit-accounts"):
+    """Adds credits to accounts from a CSV or NDJSON file with account,
+    credit_type, and credits columns. Every row is validated and all
+    accounts are fetched in one request before all credits are added in
+    one bulk request."""
+
+    rows = read_rows_file(rows_file)
+
+    # Check input
+    row_errors = {}
+    account_updates = {}
+    account_rows = {}
+    for i_row, row in enumerate(rows, start=1):
+        account = str(row.get("account") or "").strip()
+        credt_type = str(row.get("credit_type") or "").strip().casefold()
+        if account == "":
+            row_errors[i_row] = "Missing account"
+            continue
+        if credt_type not in {"cpu", "gpu"}:
+            row_errors[i_row] = f"Unknown credit type {credt_type} provided"
+            continue
+        try:
+            credts = float(row.get("credits"))
+        except (TypeError, ValueError):
+            row_errors[i_row] = f"Non-numeric credits provided: {row.get('credits')}"
+            continue
+        account_rows.setdefault(account, []).append((i_row, credt_type, credts))
+        account_update = account_updates.setdefault(
+            account, {"increments": {}, "sets": {}}
+        )
+        account_update["increments"][f"{credt_type}_credits"] = (
+            account_update["increments"].get(f"{credt_type}_credits", 0.0) + credts
+        )
+        account_update["sets"][f"{credt_type}_last_credit_date"] = str(date.today())
+
+    # Check existing
+    versions = get_existing_account_ids(es_client, account_updates, index)
+    for account, account_row_infos in account_rows.items():
+        if account not in versions:
+            for i_row, credt_type, credts in account_row_infos:
+                row_errors[i_row] = f"No existing account {account} in index {index}"
+    if len(row_errors) > 0:
+        echo_row_errors(row_errors, rows_file)
+
+    # Update accounts
+    success_count, errors = update_accounts(
+        es_client, index, account_updates, versions=versions
+    )
+
+    for account, account_row_infos in account_rows.items():
+        for i_row, credt_type, credts in account_row_infos:
+            if account in errors:
+                click.echo(
+                    f"ERROR: Row {i_row}: Failed to update account {account}: {errors[account]}",
+                    err=True,
+                )
+            else:
+                click.echo(
+                    f"Row {i_row}: added {credts} {credt_type} credits to account {account}."
+                )
+    click.echo(f"{success_count} of {len(account_updates)} accounts updated.")
+    if len(errors) > 0:
+        sys.exit(1)
+
+
 def edit_credits(es_client, account, credt_type, credts, index="cas-credit-accounts"):
     """Adds credits to account"""
 
@@ -314,14 +640,19 @@ def edit_credits(es_client, account, credt_type, credts, index="cas-credit-accou
         )
         sys.exit(1)
 
-    # Update account obj
-    doc_id = existing_account_results["hits"]["hits"][0]["_id"]
-    account_info = existing_account_results["hits"]["hits"][0]["_source"]
-    account_info[f"{credt_type}_credits"] = credts
-    account_info[f"{credt_type}_last_credit_date"] = str(date.today())
-
-    # Upload account
-    es_client.index(index=index, id=doc_id, body=account_info)
+    # Update account
+    update_account(
+        es_client,
+        account,
+        existing_account_results["hits"]["hits"][0],
+        {
+            "sets": {
+                f"{credt_type}_credits": credts,
+                f"{credt_type}_last_credit_date": str(date.today()),
+            }
+        },
+        index,
+    )
     click.echo(f"Account {account} updated.")
 
 
@@ -349,13 +680,14 @@ def edit_charges(es_client, account, charge_type, charges, index="cas-credit-acc
         )
         sys.exit(1)
 
-    # Update account obj
-    doc_id = existing_account_results["hits"]["hits"][0]["_id"]
-    account_info = existing_account_results["hits"]["hits"][0]["_source"]
-    account_info[f"{charge_type}_charges"] = charges
-
-    # Upload account
-    es_client.index(index=index, id=doc_id, body=account_info)
+    # Update account
+    update_account(
+        es_client,
+        account,
+        existing_account_results["hits"]["hits"][0],
+        {"sets": {f"{charge_type}_charges": charges}},
+        index,
+    )
     click.echo(f"Account {account} updated.")
 
 
@@ -386,13 +718,14 @@ def add_charges(es_client, account, charge_type, charges, index="cas-credit-acco
         )
         sys.exit(1)
 
-    # Update account obj
-    doc_id = existing_account_results["hits"]["hits"][0]["_id"]
-    account_info = existing_account_results["hits"]["hits"][0]["_source"]
-    account_info[f"{charge_type}_charges"] += charges
-
-    # Upload account
-    es_client.index(index=index, id=doc_id, body=account_info)
+    # Update account
+    update_account(
+        es_client,
+        account,
+        existing_account_results["hits"]["hits"][0],
+        {"increments": {f"{charge_type}_charges": charges}},
+        index,
+    )
     click.echo(f"Account {account} updated.")
 
 
@@ -403,7 +736,11 @@ def update_total_charges(
     charge_index="cas-daily-charge-records-*",
     account_index="cas-credit-accounts",
 ):
-    # Loop over charges from time period
+    """Adds charges from a time period to account totals"""
+
+    start_time = time.time()
+
+    # Get charges from time period
     charge_data = get_charge_data(
         es_client,
         start_date,
@@ -412,37 +749,80 @@ def update_total_charges(
         account_index=account_index,
     )
     charge_data.sort(key=itemgetter("date", "account_id"))
-    for charge in charge_data:
-        # Get account data
-        account_data = query_account(
-            es_client, account=charge["account_id"], index=account_index
+
+    # Get data of the charged accounts at once, sized to also find
+    # duplicates of each
+    accounts = list({charge["account_id"] for charge in charge_data})
+    account_hits = {}
+    if len(accounts) > 0:
+        results = es_client.search(
+            index=account_index,
+            body={
+                "query": {"terms": {"account_id": accounts}},
+                "size": 2 * len(accounts),
+                "seq_no_primary_term": True,
+            },
         )
-        if len(account_data["hits"]["hits"]) == 0:
+        for hit in results["hits"]["hits"]:
+            account_hits.setdefault(hit["_source"]["account_id"], []).append(hit)
+
+    # Check dates and total up charges per account and charge type
+    account_updates = {}
+    for charge in charge_data:
+        account = charge["account_id"]
+        if len(account_hits.get(account, [])) == 0:
             click.echo(
-                f"""ERROR: No existing account '{charge["account_id"]}' in index '{account_index}'""", err=True
+                f"ERROR: No existing account '{account}' in index '{account_index}'",
+                err=True,
             )
             sys.exit(1)
-        if len(account_data["hits"]["hits"]) > 1:
+        if len(account_hits[account]) > 1:
             click.echo(
-                f"""ERROR: Multiple accounts found for '{charge["account_id"]}' in index '{account_index}'""",
+                f"ERROR: Multiple accounts found for '{account}' in index '{account_index}'",
                 err=True,
             )
             sys.exit(1)
-        doc = account_data["hits"]["hits"][0]
+        account_info = account_hits[account][0]["_source"]
 
-        doc_id = doc["_id"]
-        account_info = doc["_source"]
-
-        # Check dates
         charge_type = charge["charge_type"]
-        if charge["date"] <= account_info[f"{charge_type}_last_charge_date"]:
+        if charge["date"] <= account_info.get(f"{charge_type}_last_charge_date", ""):
             raise ValueError(
-                f"""An added {charge_type} charge would come before or on last {charge_type} charge date on account '{charge["account_id"]}'"""
+                f"An added {charge_type} charge would come before or on last {charge_type} charge date on account '{account}'"
             )
 
-        # Modify account data
-        account_info[f"{charge_type}_charges"] += charge["total_charges"]
-        account_info[f"{charge_type}_last_charge_date"] = charge["date"]
+        account_update = account_updates.setdefault(
+            account, {"increments": {}, "sets": {}, "before": {}}
+        )
+        account_update["increments"][f"{charge_type}_charges"] = (
+            account_update["increments"].get(f"{charge_type}_charges", 0.0)
+            + charge["total_charges"]
+        )
+        account_update["sets"][f"{charge_type}_last_charge_date"] = charge["date"]
+
+        # Charges are sorted by date, so this is the earliest added charge.
+        # Checked again when writing in case the account changed meanwhile.
+        account_update["before"].setdefault(
+            f"{charge_type}_last_charge_date", charge["date"]
+        )
+
+    # Upload modified accounts
+    updates = {}
+    versions = {}
+    for account, account_update in account_updates.items():
+        hit = account_hits[account][0]
+        updates[hit["_id"]] = account_update
+        versions[hit["_id"]] = (hit["_seq_no"], hit["_primary_term"])
+    success_count, errors = update_accounts(
+        es_client, account_index, updates, versions=versions
+    )
+    for doc_id, error_infos in errors.items():
+        click.echo(
+            f"ERROR: Failed to update account {doc_id} in index {account_index}: {error_infos}",
+            err=True,
+        )
 
-        # Upload modified account
-        es_client.index(index=account_index, id=doc_id, body=account_info)
+    click.echo(
+        f"Added {len(charge_data)} charges to {success_count} of {len(updates)} accounts in {time.time() - start_time:.1f} seconds."
+    )
+    if len(errors) > 0:
+        sys.exit(1)
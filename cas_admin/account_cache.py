@@ -0,0 +1,85 @@
+from copy import deepcopy
+
+from cas_admin.query_utils import query_account, add_account_cols
+
+
+class AccountCache:
+    """Run-scoped cache of the credit account index
+
+    The account index is read once on first use and shared by everything
+    that is handed the same cache (computing, applying and snapshotting
+    charges, generating reports). Updates made through update() are
+    applied to the cached docs in place so they don't need to be re-read.
+    Call invalidate() if accounts may have been changed by anything else,
+    and the index will be read again on next use."""
+
+    def __init__(self, es_client, index="cas-credit-accounts", page_size=1000):
+        self.es_client = es_client
+        self.index = index
+        self.page_size = page_size
+        self._hits = None
+
+    def invalidate(self):
+        """Drops the cached accounts"""
+        self._hits = None
+
+    def load(self):
+        """(Re)reads all accounts from the index"""
+        hits = query_account(
+            self.es_client, index=self.index, page_size=self.page_size
+        )["hits"]["hits"]
+        self._hits = {hit["_id"]: hit for hit in hits}
+
+    def hits(self, account=None):
+        """Returns account search hits, optionally for a single account id"""
+        if self._hits is None:
+            self.load()
+        return [
+            deepcopy(hit)
+            for hit in self._hits.values()
+            if account is None or hit["_source"]["account_id"] == account
+        ]
+
+    def get_account_data(self, account=None, addl_cols=[]):
+        """Returns rows of account data"""
+        return [
+            add_account_cols(hit["_source"], addl_cols) for hit in self.hits(account)
+        ]
+
+    def get_account_emails(self, active_since=None):
+        """Returns account ids (active since a given date)"""
+        active_accounts = {}
+        for row in self.get_account_data():
+            if active_since is not None and not any(
+                row.get(f"{charge_type}_last_charge_date", "") >= str(active_since)
+                for charge_type in ["cpu", "gpu"]
+            ):
+                continue
+            active_accounts[row["account_id"]] = row["owner_email"]
+        return active_accounts
+
+    def versions(self, doc_ids=None):
+        """Returns known (seq_no, primary_term) tuples per doc id"""
+        if self._hits is None:
+            self.load()
+        return {
+            doc_id: (hit["_seq_no"], hit["_primary_term"])
+            for doc_id, hit in self._hits.items()
+            if (doc_ids is None or doc_id in doc_ids) and "_seq_no" in hit
+        }
+
+    def update(self, doc_id, update):
+        """Applies a successfully written partial update (see
+        bulk_utils.update_accounts) to a cached account"""
+        if self._hits is None or doc_id not in self._hits:
+            return
+        hit = self._hits[doc_id]
+        source = hit["_source"]
+        for field, value in update.get("increments", {}).items():
+            source[field] = (source.get(field) or 0) + value
+        for field, value in update.get("sets", {}).items():
+            source[field] = value
+
+        # The write bumped the doc version, let the next write look it up
+        hit.pop("_seq_no", None)
+        hit.pop("_primary_term", None)
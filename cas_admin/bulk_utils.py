@@ -0,0 +1,190 @@
+from elasticsearch.helpers import streaming_bulk
+
+
+class BulkWriter:
+    """Streams bulk actions from many accounts through streaming_bulk,
+    retrying rejected (429) chunks with backoff, and collects errors
+    per account. Indices are refreshed once when the writer is closed."""
+
+    def __init__(
+        self,
+        es_client,
+        chunk_size=500,
+        max_chunk_bytes=10 * 1024 * 1024,
+        max_retries=5,
+        initial_backoff=2,
+        max_backoff=60,
+        buffer_size=10000,
+    ):
+        self.es_client = es_client
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.buffer_size = buffer_size
+        self._reset()
+
+    def _reset(self):
+        self.actions = []
+        self.accounts = {}
+        self.indices = set()
+        self.success_count = 0
+        self.errors = {}
+
+    def add(self, account, action):
+        """Queues an action on behalf of an account"""
+        self.actions.append(action)
+        self.accounts[action["_id"]] = account
+        self.indices.add(action["_index"])
+        if len(self.actions) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Sends all queued actions without refreshing"""
+        if len(self.actions) == 0:
+            return
+        results = streaming_bulk(
+            self.es_client,
+            self.actions,
+            chunk_size=self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            max_retries=self.max_retries,
+            initial_backoff=self.initial_backoff,
+            max_backoff=self.max_backoff,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+        # Retried actions are returned out of order, so match results
+        # back up to accounts by doc id
+        for ok, info in results:
+            if ok:
+                self.success_count += 1
+            else:
+                doc_id = next(iter(info.values())).get("_id")
+                account = self.accounts.get(doc_id)
+                self.errors.setdefault(account, []).append(info)
+        self.actions = []
+        self.accounts = {}
+
+    def close(self):
+        """Sends all queued actions, refreshes the written indices once,
+        and returns the success count and the errors per account"""
+        self.flush()
+        if len(self.indices) > 0:
+            self.es_client.indices.refresh(index=",".join(sorted(self.indices)))
+        success_count, errors = self.success_count, self.errors
+        self._reset()
+        return success_count, errors
+
+
+# Checks params.before, then adds params.increments to and sets params.sets
+# on an account doc
+ACCOUNT_UPDATE_SCRIPT = """
+for (entry in params.before.entrySet()) {
+    def value = ctx._source[entry.getKey()];
+    if (value != null && value.compareTo(entry.getValue()) >= 0) {
+        throw new IllegalArgumentException(
+            entry.getKey() + ' is ' + value + ', not before ' + entry.getValue()
+        );
+    }
+}
+for (entry in params.increments.entrySet()) {
+    def value = ctx._source[entry.getKey()];
+    ctx._source[entry.getKey()] = (value == null ? 0 : value) + entry.getValue();
+}
+for (entry in params.sets.entrySet()) {
+    ctx._source[entry.getKey()] = entry.getValue();
+}
+"""
+
+
+def update_accounts(
+    es_client,
+    index,
+    updates,
+    versions={},
+    writer=None,
+    max_retries=5,
+    on_conflict=None,
+):
+    """Applies partial updates to account docs using a painless script,
+    guarded by if_seq_no/if_primary_term. Docs that were modified in the
+    meantime are re-read and retried up to max_retries times.
+
+    updates maps doc ids to dicts with "increments" and/or "sets" dicts of
+    fields, and optionally a "before" dict of fields that must be missing
+    or less than the given values for the update to be made, which is
+    checked against the doc as it is on every try. versions may map doc
+    ids to known (seq_no, primary_term) tuples to skip the initial read.
+    on_conflict, if given, is called with the id of each doc that was
+    modified in the meantime. Returns the success count and the errors
+    per doc id."""
+
+    if writer is None:
+        writer = BulkWriter(es_client)
+
+    pending = dict(updates)
+    versions = dict(versions)
+    success_count = 0
+    errors = {}
+    for attempt in range(max_retries + 1):
+        if len(pending) == 0:
+            break
+
+        # Read the current versions of docs that don't have one
+        unknown_ids = [doc_id for doc_id in pending if doc_id not in versions]
+        if len(unknown_ids) > 0:
+            docs = es_client.mget(
+                index=index, body={"ids": unknown_ids}, _source=False
+            )
+            for doc in docs["docs"]:
+                if not doc.get("found", False):
+                    errors[doc["_id"]] = [f"No document '{doc['_id']}' in '{index}'"]
+                    pending.pop(doc["_id"])
+                    continue
+                versions[doc["_id"]] = (doc["_seq_no"], doc["_primary_term"])
+
+        for doc_id, update in pending.items():
+            seq_no, primary_term = versions[doc_id]
+            writer.add(
+                doc_id,
+                {
+                    "_op_type": "update",
+                    "_index": index,
+                    "_id": doc_id,
+                    "if_seq_no": seq_no,
+                    "if_primary_term": primary_term,
+                    "script": {
+                        "source": ACCOUNT_UPDATE_SCRIPT,
+                        "lang": "painless",
+                        "params": {
+                            "increments": update.get("increments", {}),
+                            "sets": update.get("sets", {}),
+                            "before": update.get("before", {}),
+                        },
+                    },
+                },
+            )
+        attempt_success_count, attempt_errors = writer.close()
+        success_count += attempt_success_count
+
+        # Retry version conflicts with fresh versions, give up on the rest
+        retry = {}
+        for doc_id, error_infos in attempt_errors.items():
+            if all(
+                next(iter(error_info.values())).get("status") == 409
+                for error_info in error_infos
+            ):
+                retry[doc_id] = pending[doc_id]
+                versions.pop(doc_id, None)
+                if on_conflict is not None:
+                    on_conflict(doc_id)
+            else:
+                errors[doc_id] = error_infos
+        pending = retry
+
+    for doc_id in pending:
+        errors[doc_id] = [f"Version conflict after {max_retries} retries"]
+
+    return success_count, errors
@@ -1,13 +1,17 @@
 import click
 from datetime import datetime, timedelta
+from pathlib import Path
 
 from cas_admin.connect import connect
 from cas_admin.account import (
     add_account,
+    add_accounts_from_file,
     edit_owner,
     add_credits,
+    add_credits_from_file,
     display_account,
     display_all_accounts,
+    display_account_balances,
 )
 from cas_admin.usage import display_charges
 import cas_admin.cost_functions as cost_functions
@@ -66,9 +70,10 @@ def cli(ctx, es_host, es_user, es_pass, es_use_https, es_ca_certs):
 
     \b
     cas_admin get accounts - View credit account(s)
-    cas_admin create account - Create a credit account
+    cas_admin create account - Create a credit account (or accounts from a file)
     cas_admin edit account - Modify a credit account's owner or email
-    cas_admin add credits - Add credits to a credit account
+    cas_admin add credits - Add credits to a credit account (or accounts from a file)
+    cas_admin get balances - View a credit account's daily balances over a date range
     cas_admin get charges - View credit charges for a given date
 
     To get help on any of these commands, use --help after the command, for example:
@@ -86,9 +91,9 @@ def create(ctx):
 
 
 @create.command("account", no_args_is_help=True, short_help="Create a credit account")
-@click.argument("name", metavar="ACCOUNT_NAME")
-@click.option("--owner", required=True)
-@click.option("--email", required=True)
+@click.argument("name", metavar="ACCOUNT_NAME", required=False)
+@click.option("--owner")
+@click.option("--email")
 @click.option("--project", default="")
 @click.option(
     "--cpu_function",
@@ -102,6 +107,13 @@ def create(ctx):
 )
 @click.option("--cpu_credits", "cpu_credts", metavar="CREDITS", type=float, default=0.0)
 @click.option("--gpu_credits", "gpu_credts", metavar="CREDITS", type=float, default=0.0)
+@click.option(
+    "--from-file",
+    "from_file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Create all accounts listed in a CSV (.csv) or NDJSON file.",
+)
 @click.option(
     "--es_index", envvar="CAS_ACCOUNT_INDEX", default="cas-credit-accounts", hidden=True
 )
@@ -116,6 +128,7 @@ def create_account(
     gpu_function,
     cpu_credts,
     gpu_credts,
+    from_file,
     es_index,
 ):
     """Create a credit account named ACCOUNT_NAME.
@@ -127,7 +140,21 @@ def create_account(
 
     \b
     cas_admin create account AliceGroup --owner "Alice Smith" --email alice.smith@wisc.edu
+
+    Many accounts can be created at once with --from-file, given a CSV file with a header row or a
+    newline-delimited JSON file with account, owner, and email fields and optional project,
+    cpu_function, gpu_function, cpu_credits, and gpu_credits fields, for example:
+
+    \b
+    cas_admin create account --from-file new_accounts.csv
     """
+    if from_file is not None:
+        add_accounts_from_file(es_client, from_file, es_index)
+        return
+    if name is None:
+        raise click.UsageError("Missing argument 'ACCOUNT_NAME'.")
+    if owner is None or email is None:
+        raise click.UsageError("Options '--owner' and '--email' are required.")
     add_account(
         es_client,
         name,
@@ -178,18 +205,26 @@ def add(ctx):
     short_help="Add credits to a credit account",
     options_metavar=None,
 )
-@click.argument("name", metavar="ACCOUNT_NAME")
+@click.argument("name", metavar="ACCOUNT_NAME", required=False)
 @click.argument(
     "credt_type",
     metavar="CREDIT_TYPE",
     type=click.Choice(["cpu", "gpu"], case_sensitive=False),
+    required=False,
+)
+@click.argument("credts", metavar="CREDITS", type=float, required=False)
+@click.option(
+    "--from-file",
+    "from_file",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Add all credits listed in a CSV (.csv) or NDJSON file.",
 )
-@click.argument("credts", metavar="CREDITS", type=float)
 @click.option(
     "--es_index", envvar="CAS_ACCOUNT_INDEX", default="cas-credit-accounts", hidden=True
 )
 @click.pass_obj
-def add_account_credits(es_client, name, credt_type, credts, es_index):
+def add_account_credits(es_client, name, credt_type, credts, from_file, es_index):
     """Add CREDITS credits of type CREDIT_TYPE to credit account ACCOUNT_NAME.
 
     For example, to add 10 CPU credits to AliceGroup:
@@ -200,11 +235,24 @@ def add_account_credits(es_client, name, credt_type, credts, es_index):
     If needed, you can subtract credits from an account by specifying "--" first:
 
     \b
-    cas_admin add credits -- AliceGroup cpu -10"""
+    cas_admin add credits -- AliceGroup cpu -10
+
+    Credits can be added to many accounts at once with --from-file, given a CSV file with a header
+    row or a newline-delimited JSON file with account, credit_type, and credits fields, for example:
+
+    \b
+    cas_admin add credits --from-file allocations.csv"""
+    if from_file is not None:
+        add_credits_from_file(es_client, from_file, es_index)
+        return
+    if name is None or credt_type is None or credts is None:
+        raise click.UsageError("ACCOUNT_NAME, CREDIT_TYPE, and CREDITS are required.")
     add_credits(es_client, name, credt_type, credts, es_index)
 
 
-@cli.group(no_args_is_help=True, short_help="[accounts|charges]", options_metavar=None)
+@cli.group(
+    no_args_is_help=True, short_help="[accounts|balances|charges]", options_metavar=None
+)
 @click.pass_context
 def get(ctx):
     pass
@@ -240,12 +288,31 @@ def get(ctx):
     help="Sort table by given field, defaults to Name.",
 )
 @click.option("--reverse", is_flag=True, default=False, help="Reverse table sorting.")
+@click.option(
+    "--as-of",
+    "as_of",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Display credit accounts as they were at the end of a past date.",
+)
+@click.option(
+    "--snapshot_dir",
+    envvar="CAS_CREDIT_ACCOUNTS_SNAPSHOTS_DIR",
+    default=Path("./cas-credit-accounts-snapshots"),
+    type=click.Path(file_okay=False, path_type=Path),
+    hidden=True,
+)
 @click.option(
     "--es_index", envvar="CAS_ACCOUNT_INDEX", default="cas-credit-accounts", hidden=True
 )
 @click.pass_obj
-def get_accounts(es_client, name, sortby, reverse, es_index):
-    """Display credit accounts."""
+def get_accounts(es_client, name, sortby, reverse, as_of, snapshot_dir, es_index):
+    """Display credit accounts.
+
+    Past account states are read from the daily account snapshots when using --as-of,
+    which must be in YYYY-MM-DD format."""
+    if as_of is not None:
+        as_of = as_of.date()
     sortby = sortby.casefold()
     sort_map = {
         "name": "account_id",
@@ -261,9 +328,45 @@ def get_accounts(es_client, name, sortby, reverse, es_index):
         "gpuremain": "remaining_gpu_credits",
     }
     if name is not None:
-        display_account(es_client, name, es_index)
+        display_account(es_client, name, es_index, as_of, snapshot_dir)
     else:
-        display_all_accounts(es_client, sort_map[sortby], reverse, es_index)
+        display_all_accounts(
+            es_client, sort_map[sortby], reverse, es_index, as_of, snapshot_dir
+        )
+
+
+@get.command(
+    "balances",
+    no_args_is_help=True,
+    short_help="View a credit account's daily balances over a date range",
+)
+@click.argument("name", metavar="ACCOUNT_NAME")
+@click.option(
+    "--start",
+    "start_date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    required=True,
+    help="First date to display, in YYYY-MM-DD format.",
+)
+@click.option(
+    "--end",
+    "end_date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=YESTERDAY,
+    help="Last date to display, in YYYY-MM-DD format, defaults to yesterday.",
+)
+@click.option(
+    "--snapshot_dir",
+    envvar="CAS_CREDIT_ACCOUNTS_SNAPSHOTS_DIR",
+    default=Path("./cas-credit-accounts-snapshots"),
+    type=click.Path(file_okay=False, path_type=Path),
+    hidden=True,
+)
+@click.pass_obj
+def get_balances(es_client, name, start_date, end_date, snapshot_dir):
+    """Displays the credits and charges of credit account ACCOUNT_NAME
+    at the end of each day from --start to --end, read from the daily account snapshots."""
+    display_account_balances(name, start_date.date(), end_date.date(), snapshot_dir)
 
 
 @get.command("charges", short_help="View credit charges from one day")
@@ -1,4 +1,9 @@
-from collections import OrderedDict as _OrderedDict
+from bisect import bisect_right as _bisect_right
+
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
 
 
 def get_clean(ad, col, default_value):
@@ -10,57 +15,92 @@ def get_clean(ad, col, default_value):
         return value
 
 
-class _charge_table(_OrderedDict):
-    """Small wrapper around OrderedDict that returns the value
-    associated with the largest key smaller than the requested
-    key value."""
+def _get_clean_column(columns, col, default_value):
+    """Helper function to deal with None values in columns of ads,
+    returns a float array"""
+    return _np.array(
+        [default_value if value is None else value for value in columns[col]],
+        dtype=float,
+    )
+
+
+class _charge_table:
+    """Immutable, sorted table that returns the value associated
+    with the largest key smaller than the requested key value.
+    Tables should be built once and shared between calls."""
+
+    __slots__ = ("_keys", "_rates", "_key_array", "_rate_array")
+
+    def __init__(self, rates):
+        try:
+            items = sorted((float(k), v) for k, v in rates.items())
+        except ValueError:
+            raise ValueError(f"Charge table keys must be numeric")
+        set_attr = super().__setattr__
+        set_attr("_keys", tuple(key for key, rate in items))
+        set_attr("_rates", tuple(rate for key, rate in items))
+        if _np is not None:
+            set_attr("_key_array", _np.array(self._keys, dtype=float))
+            set_attr("_rate_array", _np.array(self._rates, dtype=float))
 
-    def __init__(self, *args, **kwargs):
-        if len(args) > 0 and isinstance(args[0], dict):
-            args = list(args)
-            try:
-                args[0] = [(float(k), v) for k, v in args[0].items()]
-            except ValueError:
-                raise ValueError(f"Charge table keys must be numeric")
-            args[0].sort(reverse=True)
-            super().__init__(*args, **kwargs)
+    def __setattr__(self, name, value):
+        raise AttributeError("Charge tables are immutable")
 
     def __getitem__(self, value):
         try:
-            float(value)
+            key = float(value)
         except ValueError:
             raise ValueError(f"Charge table keys must be numeric")
-        for key in self.keys():
-            if float(value) >= key:
-                return super().__getitem__(key)
-        raise ValueError(f"Value '{value}' does not exist in defined ranges")
+        if not key >= self._keys[0]:
+            raise ValueError(f"Value '{value}' does not exist in defined ranges")
+        return self._rates[_bisect_right(self._keys, key) - 1]
+
+    def lookup(self, values):
+        """Returns an array of the values associated with each
+        of an array of keys"""
+        out_of_range = ~(values >= self._key_array[0])
+        if out_of_range.any():
+            value = values[out_of_range][0]
+            raise ValueError(f"Value '{value}' does not exist in defined ranges")
+        return self._rate_array[
+            _np.searchsorted(self._key_array, values, side="right") - 1
+        ]
 
 
 # Cost functions return the charge per resource in a dict.
 # For example, for a job that should be charged 0.5 credits for CPU usage
 # and 0.2 credits for memory usage, the function should return:
 # {"cpu": 0.5, "memory": 0.2}
+#
+# Cost functions must declare the job ad attributes they read as a list
+# in an .inputs attribute so that only those attributes are fetched.
+#
+# When NumPy is available, cost functions may also provide a batch
+# function as a .batch attribute that takes a dict of columns of ad
+# values and returns the charge per resource as a dict of arrays.
 
+_CPU_2022_CPU_TABLE = _charge_table(
+    {
+        0: 1.0,
+        2: 1.2,
+        9: 1.5,
+        33: 2.0,
+    }
+)
+_CPU_2022_MEMORY_TABLE = _charge_table(
+    {
+        0: 0,
+        0.001: 0.125,
+        8.001: 0.250,
+        32.001: 0.375,
+        128.001: 0.50,
+    }
+)
 
-def cpu_2022(ad):
-    cpu_charge_table = _charge_table(
-        {
-            0: 1.0,
-            2: 1.2,
-            9: 1.5,
-            33: 2.0,
-        }
-    )
 
-    memory_charge_table = _charge_table(
-        {
-            0: 0,
-            0.001: 0.125,
-            8.001: 0.250,
-            32.001: 0.375,
-            128.001: 0.50,
-        }
-    )
+def cpu_2022(ad):
+    cpu_charge_table = _CPU_2022_CPU_TABLE
+    memory_charge_table = _CPU_2022_MEMORY_TABLE
 
     cpu_hyperthread_discount = 0.4
     nominal_memory_gb_per_cpu = 2
@@ -86,31 +126,68 @@ def cpu_2022(ad):
     return charge
 
 
-def gpu_2022(ad):
-    gpu_charge_table = _charge_table(
-        {
-            0: 0,
-            1: 1.0,
-            2: 1.2,
-            3: 1.5,
-            4: 2.0,
-        }
+def _cpu_2022_batch(columns):
+    cpu_charge_table = _CPU_2022_CPU_TABLE
+    memory_charge_table = _CPU_2022_MEMORY_TABLE
+
+    cpu_hyperthread_discount = 0.4
+    nominal_memory_gb_per_cpu = 2
+
+    cpus = _get_clean_column(columns, "RequestCpus", 1)
+    cpu_hyperthread = _get_clean_column(columns, "IsHyperthreadCpu", False)
+    memory_gb = _get_clean_column(columns, "RequestMemory", 0) / 1024
+    hours = _get_clean_column(columns, "RemoteWallClockTime", 0) / 3600
+
+    above_nominal_memory_gb = _np.maximum(
+        memory_gb - (cpus * nominal_memory_gb_per_cpu), 0
     )
-    cpu_charge_table = _charge_table(
-        {
-            0: 0,
-            1: 0.125,
-            49: 0.20,
-        }
+
+    charge = {}
+    charge["cpu"] = (
+        cpus
+        * hours
+        * cpu_charge_table.lookup(cpus)
+        * (1 - (cpu_hyperthread * cpu_hyperthread_discount))
     )
-    memory_charge_table = _charge_table(
-        {
-            0: 0,
-            0.001: 0.012,
-            384.001: 0.20,
-        }
+    charge["memory"] = (
+        above_nominal_memory_gb
+        * hours
+        * memory_charge_table.lookup(above_nominal_memory_gb)
     )
 
+    return charge
+
+
+_GPU_2022_GPU_TABLE = _charge_table(
+    {
+        0: 0,
+        1: 1.0,
+        2: 1.2,
+        3: 1.5,
+        4: 2.0,
+    }
+)
+_GPU_2022_CPU_TABLE = _charge_table(
+    {
+        0: 0,
+        1: 0.125,
+        49: 0.20,
+    }
+)
+_GPU_2022_MEMORY_TABLE = _charge_table(
+    {
+        0: 0,
+        0.001: 0.012,
+        384.001: 0.20,
+    }
+)
+
+
+def gpu_2022(ad):
+    gpu_charge_table = _GPU_2022_GPU_TABLE
+    cpu_charge_table = _GPU_2022_CPU_TABLE
+    memory_charge_table = _GPU_2022_MEMORY_TABLE
+
     cpu_hyperthread_discount = 0.4
     nominal_cpus_per_gpu = 16
     nominal_memory_gb_per_gpu = 2
@@ -139,3 +216,55 @@ def gpu_2022(ad):
     )
 
     return charge
+
+
+def _gpu_2022_batch(columns):
+    gpu_charge_table = _GPU_2022_GPU_TABLE
+    cpu_charge_table = _GPU_2022_CPU_TABLE
+    memory_charge_table = _GPU_2022_MEMORY_TABLE
+
+    gpus = _get_clean_column(columns, "RequestGpus", 0)
+    cpus = _get_clean_column(columns, "RequestCpus", 1)
+    memory_gb = _get_clean_column(columns, "RequestMemory", 0) / 1024
+    hours = _get_clean_column(columns, "RemoteWallClockTime", 0) / 3600
+
+    has_gpus = gpus > 0
+    safe_gpus = _np.where(has_gpus, gpus, 1)
+    above_nominal_cpus_per_gpu = _np.where(
+        has_gpus, _np.maximum((cpus - 16 * gpus) / safe_gpus, 0), cpus
+    )
+    above_nominal_memory_gb = _np.where(
+        has_gpus, _np.maximum((memory_gb - 128 * gpus), 0), memory_gb
+    )
+    above_nominal_memory_gb_per_gpu = _np.where(
+        has_gpus, above_nominal_memory_gb / safe_gpus, memory_gb
+    )
+
+    charge = {}
+    charge["gpu"] = gpus * hours * gpu_charge_table.lookup(gpus)
+    charge["cpu"] = cpus * hours * cpu_charge_table.lookup(above_nominal_cpus_per_gpu)
+    charge["memory"] = (
+        above_nominal_memory_gb
+        * hours
+        * memory_charge_table.lookup(above_nominal_memory_gb_per_gpu)
+    )
+
+    return charge
+
+
+cpu_2022.inputs = [
+    "RequestCpus",
+    "IsHyperthreadCpu",
+    "RequestMemory",
+    "RemoteWallClockTime",
+]
+gpu_2022.inputs = [
+    "RequestGpus",
+    "RequestCpus",
+    "RequestMemory",
+    "RemoteWallClockTime",
+]
+
+if _np is not None:
+    cpu_2022.batch = _cpu_2022_batch
+    gpu_2022.batch = _gpu_2022_batch
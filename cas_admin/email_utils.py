@@ -1,9 +1,6 @@
 import click
 import xlsxwriter
 import json
-import time
-import smtplib
-import dns.resolver
 from operator import itemgetter
 from collections import OrderedDict
 from datetime import timedelta
@@ -12,56 +9,19 @@ from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 from pathlib import Path
-from cas_admin.account import get_account_data, get_charge_data
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cas_admin.account import get_charge_data
+from cas_admin.query_utils import iter_charge_data
+from cas_admin.account_cache import AccountCache
+from cas_admin.mail_sender import MailSender, DirectMailSender
+from cas_admin.report_html import HTMLReport, td, value_td, get_charge_class
 
 
 def _smtp_mail(
     msg, recipient, smtp_server=None, smtp_username=None, smtp_password=None
 ):
-    sent = False
-    result = None
-    tries = 0
-    sleeptime = 0
-    while tries < 3 and sleeptime < 600:
-        try:
-            if smtp_username is None:
-                smtp = smtplib.SMTP(smtp_server)
-            else:
-                smtp = smtplib.SMTP_SSL(smtp_server)
-                smtp.login(smtp_username, smtp_password)
-        except Exception:
-            click.echo(f"Could not connect to SMTP server: {smtp_server}", err=True)
-            continue
-
-        try:
-            result = smtp.sendmail(msg["From"], recipient, msg.as_string())
-            if len(result) > 0:
-                click.echo(
-                    f"Could not send email to {recipient} using server {smtp_server}:\n{result}",
-                    err=True,
-                )
-            else:
-                sent = True
-        except Exception:
-            click.echo(
-                f"Could not send to {recipient} using server {smtp_server}", err=True
-            )
-        finally:
-            try:
-                smtp.quit()
-            except smtplib.SMTPServerDisconnected:
-                pass
-        if sent:
-            break
-
-        sleeptime = int(min(30 * 1.5**tries, 600))
-        time.sleep(sleeptime)
-        tries += 1
-
-    else:
-        logger.error(f"Failed to send email after {tries} loops")
-
-    return sent
+    with MailSender(smtp_server, smtp_username, smtp_password, pool_size=1) as sender:
+        return sender.send(msg, recipient).result()
 
 
 def send_email(
@@ -76,7 +36,13 @@ def send_email(
     smtp_server=None,
     smtp_username=None,
     smtp_password_file=None,
+    sender=None,
 ):
+    """Sends an email, through smtp_server if given or else directly to
+    the recipients' mail exchangers. If a MailSender or DirectMailSender
+    is given, the email is sent with it (sharing its connections) and a
+    Future of whether it was sent is returned."""
+
     if len(to_addrs) == 0:
         click.echo("No recipients in the To: field, not sending email", err=True)
         return
@@ -103,41 +69,17 @@ def send_email(
         part.add_header("Content-Disposition", "attachment", filename=path.name)
         msg.attach(part)
 
-    if smtp_server is not None:  # use SMTP
+    if sender is not None:  # use shared SMTP connections
+        return sender.send(msg, list(set(to_addrs + cc_addrs + bcc_addrs)))
+    elif smtp_server is not None:  # use SMTP
         recipient = list(set(to_addrs + cc_addrs + bcc_addrs))
         smtp_password = None
         if smtp_password_file is not None:
             smtp_password = smtp_password_file.open("r").read().strip()
         _smtp_mail(msg, recipient, smtp_server, smtp_username, smtp_password)
     else:  # lookup MX record and send emails directly
-        for recipient in to_addrs + cc_addrs + bcc_addrs:
-            domain = recipient.split("@")[1]
-            sent = False
-            result = None
-            for mx in dns.resolver.query(domain, "MX"):
-                mailserver = str(mx).split()[1][:-1]
-                try:
-                    smtp = smtplib.SMTP(mailserver)
-                    result = smtp.sendmail(from_addr, recipient, msg.as_string())
-                    smtp.quit()
-                except Exception:
-                    click.echo(
-                        f"WARNING: Could not send to {recipient} using {mailserver}",
-                        err=True,
-                    )
-                    if result is not None:
-                        click.echo(
-                            f"WARNING: Got result: {result} from {mailserver}", err=True
-                        )
-                else:
-                    sent = True
-                if sent:
-                    break
-            else:
-                click.echo(
-                    f"ERROR: Could not send to {recipient} using any mailserver",
-                    err=True,
-                )
+        with DirectMailSender() as sender:
+            sender.send(msg, to_addrs + cc_addrs + bcc_addrs)
 
 
 def generate_weekly_accounts_report(
@@ -145,8 +87,17 @@ def generate_weekly_accounts_report(
     starting_week_date,
     xlsx_directory=Path("./weekly_accounts_reports"),
     index="cas-credit-accounts",
+    account_cache=None,
+    account_rows=None,
 ):
-    """Return HTML and XSLX report of per-account credits used and remaining"""
+    """Return HTML and XSLX report of per-account credits used and remaining
+
+    The accounts' data is looked up unless already given as account_rows
+    (with the percent used and remaining credits columns added), in which
+    case no Elasticsearch client is needed."""
+
+    if account_cache is None and account_rows is None:
+        account_cache = AccountCache(es_client, index)
 
     columns = OrderedDict()
     columns["account_id"] = "Account Name"
@@ -165,12 +116,8 @@ def generate_weekly_accounts_report(
     xlsx_directory.mkdir(parents=True, exist_ok=True)
     xlsx_file = xlsx_directory / f"cas-weekly-account-report_{date_str}.xlsx"
 
-    html = """<html>
-<head>
-</head>
-<body style="background-color: white">
-<table style="border-collapse: collapse">
-"""
+    report = HTMLReport()
+    report.start_table()
     workbook = xlsxwriter.Workbook(str(xlsx_file))
     worksheet = workbook.add_worksheet()
 
@@ -179,25 +126,16 @@ def generate_weekly_accounts_report(
     xlsx_numeric_fmt = workbook.add_format({"num_format": "#,##0"})
     xlsx_percent_fmt = workbook.add_format({"num_format": "#,##0.00%"})
 
-    def row_style(i):
+    def row_class(i):
         if i % 2 == 1:
-            return "background-color: #ddd"
-        return "background-color: white"
-
-    def col_html(x):
-        try:
-            x = float(x)
-            return f"""<td style="text-align: right; border: 1px solid black">{x:,.1f}</td>"""
-        except ValueError:
-            return f"""<td style="text-align: left; border: 1px solid black">{x}</td>"""
+            return "odd"
+        return "even"
 
     # Write header
     i_row = 0
-    html += f"""<tr style="{row_style(0)}">\n"""
+    report.header_row(columns.values(), row_class(0))
     for i_col, (column_id, column_name) in enumerate(columns.items()):
-        html += f"""<th style="text-align: center; border: 1px solid black">{column_name}</th>"""
         worksheet.write(i_row, i_col, column_name, xlsx_header_fmt)
-    html += "</tr>\n"
 
     # Get row data
     addl_cols = [
@@ -206,11 +144,13 @@ def generate_weekly_accounts_report(
         "percent_gpu_credits_used",
         "remaining_gpu_credits",
     ]
-    rows = get_account_data(es_client, addl_cols=addl_cols, index=index)
+    if account_rows is None:
+        account_rows = account_cache.get_account_data(addl_cols=addl_cols)
+    rows = account_rows
 
     # Add row data to html and xlsx
     for i_row, row in enumerate(rows, start=1):
-        html += f"""<tr style="{row_style(i_row)}">\n"""
+        cells = []
         for i_col, col in enumerate(columns):
             if col in {
                 "cpu_credits",
@@ -226,22 +166,19 @@ def generate_weekly_accounts_report(
             else:
                 val = row.get(col, "")
             if col in {"percent_cpu_credits_used", "percent_gpu_credits_used"}:
-                html += f"""<td style="text-align: right; border: 1px solid black">{val:.1%}</td>"""
+                cells.append(td(f"{val:.1%}", "num"))
                 worksheet.write(i_row, i_col, val, xlsx_percent_fmt)
             else:
-                html += col_html(val)
+                cells.append(value_td(val))
                 try:
                     worksheet.write(i_row, i_col, float(val), xlsx_numeric_fmt)
                 except ValueError:
                     worksheet.write(i_row, i_col, val)
-        html += "</tr>\n"
-    html += """</table>
-</body>
-</html>
-"""
+        report.row(cells, row_class(i_row))
+    report.end_table()
     workbook.close()
 
-    return {"html": html, "xlsx_file": xlsx_file}
+    return {"html": report.getvalue(), "xlsx_file": xlsx_file}
 
 
 def generate_weekly_account_owner_report(
@@ -252,8 +189,18 @@ def generate_weekly_account_owner_report(
     snapshot_directory=Path("./weekly_accounts_snapshots"),
     account_index="cas-credit-accounts",
     charge_index="cas-daily-charge-records-*",
+    account_cache=None,
+    account_row=None,
+    charge_rows=None,
 ):
-    """Return HTML and XSLX report of per-account credits used and remaining"""
+    """Return HTML and XSLX report of per-account credits used and remaining
+
+    The account's data and last week's charges are looked up unless
+    already given as account_row and charge_rows, in which case no
+    Elasticsearch client is needed."""
+
+    if account_cache is None and account_row is None:
+        account_cache = AccountCache(es_client, account_index)
 
     # Set up global report stuff
     date_str = str(starting_week_date)
@@ -262,11 +209,7 @@ def generate_weekly_account_owner_report(
     xlsx_directory.mkdir(parents=True, exist_ok=True)
     xlsx_file = xlsx_directory / f"cas-weekly-account-report_{date_str}.xlsx"
 
-    html = """<html>
-<head>
-</head>
-<body style="background-color: white">
-"""
+    report = HTMLReport()
     workbook = xlsxwriter.Workbook(str(xlsx_file))
 
     xlsx_header_fmt = workbook.add_format({"text_wrap": True, "align": "center"})
@@ -278,18 +221,6 @@ def generate_weekly_account_owner_report(
         {"num_format": "+#,##0.0\%;-#,##0.0\%;0\%"}
     )
 
-    def row_style(i):
-        if i % 2 == 1:
-            return "background-color: #ddd"
-        return "background-color: white"
-
-    def col_style(x):
-        try:
-            x = float(x)
-            return f"""<td style="text-align: right; border: 1px solid black; padding: 4px">{x:,.1f}</td>"""
-        except ValueError:
-            return f"""<td style="text-align: left; border: 1px solid black; padding: 4px">{x}</td>"""
-
     # First create the account report
     account_columns = OrderedDict()
     account_columns["account_id"] = "Account Name"
@@ -305,8 +236,8 @@ def generate_weekly_account_owner_report(
     account_columns["owner_email"] = "Account Owner Email"
 
     account_worksheet = workbook.add_worksheet("Account summary")
-    html += """<h1>Account summary</h1>
-<table style="border-collapse: collapse">\n"""
+    report.heading("Account summary")
+    report.start_table(padded=True)
 
     numeric_cols = {
         "cpu_credits",
@@ -324,11 +255,9 @@ def generate_weekly_account_owner_report(
 
     # Write header
     i_row = 0
-    html += f"""<tr>\n"""
+    report.header_row(account_columns.values())
     for i_col, (column_id, column_name) in enumerate(account_columns.items()):
-        html += f"""<th style="text-align: center; border: 1px solid black; padding: 4px">{column_name}</th>"""
         account_worksheet.write(i_row, i_col, column_name, xlsx_header_fmt)
-    html += "</tr>\n"
 
     # Get row data
     addl_cols = [
@@ -337,16 +266,16 @@ def generate_weekly_account_owner_report(
         "percent_gpu_credits_used",
         "remaining_gpu_credits",
     ]
-    rows = get_account_data(
-        es_client, account=account, addl_cols=addl_cols, index=account_index
-    )
-    if len(rows) == 0:
-        raise ValueError(f"No account {account} found in index {index}.")
-    if len(rows) > 1:
-        raise ValueError(
-            f"Multiple accounts found for account id {account} in index {index}."
-        )
-    row = rows[0]
+    if account_row is None:
+        rows = account_cache.get_account_data(account=account, addl_cols=addl_cols)
+        if len(rows) == 0:
+            raise ValueError(f"No account {account} found in index {account_index}.")
+        if len(rows) > 1:
+            raise ValueError(
+                f"Multiple accounts found for account id {account} in index {account_index}."
+            )
+        account_row = rows[0]
+    row = account_row
 
     # Write this week's snapshot file
     snapshot_directory = snapshot_directory / account
@@ -357,22 +286,22 @@ def generate_weekly_account_owner_report(
 
     # Add row data to html and xlsx
     i_row = 1
-    html += """<tr>\n"""
+    cells = []
     for i_col, col in enumerate(account_columns):
         if col in numeric_cols | percent_cols:
             val = row.get(col, 0)
         else:
             val = row.get(col, "")
         if col in percent_cols:
-            html += f"""<td style="text-align: right; border: 1px solid black; padding: 4px">{val:.1%}</td>"""
+            cells.append(td(f"{val:.1%}", "num"))
             account_worksheet.write(i_row, i_col, val, xlsx_percent_fmt)
         else:
-            html += col_style(val)
+            cells.append(value_td(val))
             try:
                 account_worksheet.write(i_row, i_col, float(val), xlsx_numeric_fmt)
             except ValueError:
                 account_worksheet.write(i_row, i_col, val)
-    html += """</tr>\n"""
+    report.row(cells)
 
     # Read from snapshot if available
     last_date_str = str(starting_week_date - timedelta(days=7))
@@ -398,12 +327,12 @@ def generate_weekly_account_owner_report(
 
         # Add row data to html and xlsx
         i_row = 2
-        html += """<tr>\n"""
+        cells = []
         merge_to_col = list(account_columns.keys()).index("account_id")
         for i_col, col in enumerate(account_columns):
             if i_col == 0:
                 val = "Change since last report"
-                html += f"""<td style="text-align: left; border-style: none; padding: 4px" colspan="{merge_to_col+1}">{val}</td>"""
+                cells.append(td(val, "blank", colspan=merge_to_col + 1))
                 if i_col == merge_to_col:
                     account_worksheet.write(i_row, i_col, val)
                 else:
@@ -412,55 +341,17 @@ def generate_weekly_account_owner_report(
                     )
             elif col in percent_cols:
                 val = row.get(col, 0) - last_row.get(col, 0)
-                html += f"""<td style="text-align: right; border: 1px solid black; padding: 4px">{val:+,.1f}%</td>"""
+                cells.append(td(f"{val:+,.1f}%", "num"))
                 account_worksheet.write(i_row, i_col, val, xlsx_delta_pct_fmt)
             elif col in numeric_cols:
                 val = row.get(col, 0) - last_row.get(col, 0)
-                html += f"""<td style="text-align: right; border: 1px solid black; padding: 4px">{val:+,.1f}</td>"""
+                cells.append(td(f"{val:+,.1f}", "num"))
                 account_worksheet.write(i_row, i_col, val, xlsx_delta_fmt)
             else:
                 if i_col > merge_to_col:
-                    html += """<td style="border-style: none"></td>"""
-        html += """</tr>\n"""
-    html += """</table>\n"""
-
-    def get_bgcolor(charge_type=None, res_type=None):
-        if charge_type is None:
-            return ""
-        if res_type is None:
-            res_type = charge_type
-        rgbs = {
-            "cpu": (255, 238, 204),
-            "gpu": (204, 238, 255),
-        }
-        scales = {
-            "cpu": {
-                "cpu": 1.00,
-                "memory": 0.90,
-            },
-            "gpu": {
-                "cpu": 1.00,
-                "gpu": 0.95,
-                "memory": 0.90,
-            },
-        }
-        scale = scales.get(charge_type, {}).get(res_type, 1)
-        rgb_str = (f"{scale*rgb:.0f}" for rgb in rgbs.get(charge_type, (255, 255, 255)))
-        return f"background-color: rgb({', '.join(rgb_str)});"
-
-    def get_col_td(value="", charge_type=None, res_type=None):
-        bgcolor = get_bgcolor(charge_type, res_type)
-        try:
-            value = float(value)
-            style = f"text-align: right; border: 1px solid black; padding: 4px; {bgcolor}".strip().rstrip(
-                ";"
-            )
-            return f"""<td style="{style}">{value:,.1f}</td>"""
-        except ValueError:
-            style = f"text-align: left; border: 1px solid black; padding: 4px; {bgcolor}".strip().rstrip(
-                ";"
-            )
-            return f"""<td style="{style}">{value}</td>"""
+                    cells.append(td("", "blank"))
+        report.row(cells)
+    report.end_table()
 
     # Now create the charges report
     charge_columns = OrderedDict()
@@ -470,33 +361,34 @@ def generate_weekly_account_owner_report(
     charge_columns["resource_name"] = "Resource"
     charge_columns["total_charges"] = "Charges"
     charges_worksheet = workbook.add_worksheet("Charges summary")
-    html += """<h1>Last week's charges</h1>
-<table style="border-collapse: collapse">\n"""
+    report.heading("Last week's charges")
+    report.start_table(padded=True)
 
     # Write header
     i_row = 0
-    html += f"""<tr>\n"""
+    report.header_row(charge_columns.values())
     for i_col, (column_id, column_name) in enumerate(charge_columns.items()):
-        html += f"""<th style="text-align: center; border: 1px solid black; padding: 4px">{column_name}</th>"""
         charges_worksheet.write(i_row, i_col, column_name, xlsx_header_fmt)
-    html += """</tr>\n"""
 
     # Get row data
-    rows = get_charge_data(
-        es_client,
-        start_date=starting_week_date,
-        end_date=starting_week_date + timedelta(days=7),
-        account=account,
-        charge_index=charge_index,
-        account_index=account_index,
+    if charge_rows is None:
+        charge_rows = get_charge_data(
+            es_client,
+            start_date=starting_week_date,
+            end_date=starting_week_date + timedelta(days=7),
+            account=account,
+            charge_index=charge_index,
+            account_index=account_index,
+        )
+    rows = sorted(
+        charge_rows, key=itemgetter("date", "user_id", "charge_type", "resource_name")
     )
-    rows.sort(key=itemgetter("date", "user_id", "charge_type", "resource_name"))
 
     # Add row data to html and xlsx
     last_date = "1970-01-01"
     last_user = "nobody@localhost"
     for i_row, row in enumerate(rows, start=1):
-        html += """<tr>\n"""
+        cells = []
         charge_type = None
         res_type = None
         new_date = True
@@ -519,26 +411,141 @@ def generate_weekly_account_owner_report(
             elif col == "resource_name":
                 res_type = val
             if (col == "date" and not new_date) or (col == "user_id" and not new_user):
-                html += get_col_td()
+                cells.append(value_td())
             else:
-                html += get_col_td(
-                    value=val, charge_type=charge_type, res_type=res_type
-                )
+                cells.append(value_td(val, get_charge_class(charge_type, res_type)))
             try:
                 charges_worksheet.write(i_row, i_col, float(val), xlsx_numeric_fmt)
             except ValueError:
                 charges_worksheet.write(i_row, i_col, val)
-        html += """</tr>\n"""
+        report.row(cells)
         last_date = this_date
         last_user = this_user
-    html += """</table>\n"""
-
-    html += """</body>
-</html>
-"""
+    report.end_table()
     workbook.close()
 
-    return {"html": html, "xlsx_file": xlsx_file}
+    return {"html": report.getvalue(), "xlsx_file": xlsx_file}
+
+
+def get_weekly_account_owner_data(
+    es_client,
+    starting_week_date,
+    accounts=None,
+    account_index="cas-credit-accounts",
+    charge_index="cas-daily-charge-records-*",
+    account_cache=None,
+):
+    """Returns the account data and last week's charges of all (or the
+    given) accounts, read in one pass each and grouped by account"""
+
+    if account_cache is None:
+        account_cache = AccountCache(es_client, account_index)
+
+    addl_cols = [
+        "percent_cpu_credits_used",
+        "remaining_cpu_credits",
+        "percent_gpu_credits_used",
+        "remaining_gpu_credits",
+    ]
+    account_data = {}
+    for row in account_cache.get_account_data(addl_cols=addl_cols):
+        account = row["account_id"]
+        if accounts is not None and account not in accounts:
+            continue
+        if account in account_data:
+            raise ValueError(
+                f"Multiple accounts found for account id {account} in index {account_index}."
+            )
+        account_data[account] = {"account_row": row, "charge_rows": []}
+
+    for row in iter_charge_data(
+        es_client,
+        starting_week_date,
+        starting_week_date + timedelta(days=7),
+        charge_index=charge_index,
+        account_index=account_index,
+    ):
+        if row["account_id"] in account_data:
+            account_data[row["account_id"]]["charge_rows"].append(row)
+
+    return account_data
+
+
+def generate_weekly_account_owner_reports(
+    es_client,
+    starting_week_date,
+    accounts=None,
+    xlsx_directory=Path("./weekly_account_reports_by_account"),
+    snapshot_directory=Path("./weekly_accounts_snapshots"),
+    account_index="cas-credit-accounts",
+    charge_index="cas-daily-charge-records-*",
+    account_cache=None,
+    processes=1,
+):
+    """Yields (account, report, error) for all (or the given) accounts,
+    rendering each report from account and charge data fetched up front
+
+    Reports are rendered in a pool of worker processes if processes is
+    greater than one, and are yielded as soon as each one is done."""
+
+    account_data = get_weekly_account_owner_data(
+        es_client,
+        starting_week_date,
+        accounts,
+        account_index,
+        charge_index,
+        account_cache,
+    )
+    if accounts is None:
+        accounts = list(account_data)
+
+    for account in accounts:
+        if account not in account_data:
+            yield account, None, ValueError(
+                f"No account {account} found in index {account_index}."
+            )
+
+    def report_args(account):
+        return (
+            None,
+            account,
+            starting_week_date,
+            xlsx_directory,
+            snapshot_directory,
+            account_index,
+            charge_index,
+            None,
+            account_data[account]["account_row"],
+            account_data[account]["charge_rows"],
+        )
+
+    if processes <= 1:
+        for account in accounts:
+            if account not in account_data:
+                continue
+            try:
+                report = generate_weekly_account_owner_report(*report_args(account))
+            except Exception as e:
+                yield account, None, e
+                continue
+            yield account, report, None
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            executor.submit(
+                generate_weekly_account_owner_report, *report_args(account)
+            ): account
+            for account in accounts
+            if account in account_data
+        }
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as e:
+                yield futures[future], None, e
+                continue
+            yield futures[future], report, None
 
 
 ### TODO
@@ -556,22 +563,15 @@ def generate_monthly_agency_report(
     xlsx_directory.mkdir(parents=True, exist_ok=True)
     xlsx_file = xlsx_directory / f"path-cas-monthly-agency-report_{date_str}.xlsx"
 
-    html = """<html>
-<head>
-</head>
-<body style="background-color: white">
-<table style="border-collapse: collapse">
-"""
+    report = HTMLReport()
+    report.start_table()
 
     workbook = xlsxwriter.Workbook(str(xlsx_file))
     worksheet = workbook.add_worksheet()
 
     # Create table
 
-    html += """</table>
-</body>
-</html>
-"""
+    report.end_table()
     workbook.close()
 
-    return {"html": html, "xlsx_file": xlsx_file}
+    return {"html": report.getvalue(), "xlsx_file": xlsx_file}
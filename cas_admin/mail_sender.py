@@ -0,0 +1,295 @@
+import click
+import dns.resolver
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class SMTPConnectionPool:
+    """Pool of open (and logged in) SMTP connections to one server
+
+    Connections are plain SMTP unless a username is given, in which case
+    SMTP over SSL is used and the connection is logged in once when it is
+    opened. The server may include a port, e.g. "localhost:1025"."""
+
+    def __init__(self, smtp_server, smtp_username=None, smtp_password=None):
+        self.smtp_server = smtp_server
+        self.smtp_username = smtp_username
+        self.smtp_password = smtp_password
+        self._idle = queue.LifoQueue()
+
+    def connect(self):
+        if self.smtp_username is None:
+            return smtplib.SMTP(self.smtp_server)
+        smtp = smtplib.SMTP_SSL(self.smtp_server)
+        smtp.login(self.smtp_username, self.smtp_password)
+        return smtp
+
+    def get(self):
+        """Returns an idle connection, opening a new one if there are none"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def put(self, smtp):
+        """Returns a connection to the pool for reuse"""
+        self._idle.put(smtp)
+
+    def sendmail(self, msg, recipients):
+        """Sends a message on a pooled connection, reconnecting once if the
+        connection was closed while idle. Returns the refused recipients."""
+        for attempt in range(2):
+            smtp = self.get()
+            try:
+                result = smtp.sendmail(msg["From"], recipients, msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                self.discard(smtp)
+                if attempt > 0:
+                    raise
+                continue
+            except Exception:
+                self.discard(smtp)
+                raise
+            self.put(smtp)
+            return result
+
+    def discard(self, smtp):
+        """Closes a connection that should not be reused"""
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class RateLimiter:
+    """Spaces out calls to wait() to at most rate per second"""
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            this_time = max(now, self._next_time)
+            self._next_time = this_time + self.interval
+        time.sleep(this_time - now)
+
+
+class MailSender:
+    """Sends messages through an SMTP server concurrently
+
+    Messages are sent by up to pool_size threads, each reusing connections
+    from a shared SMTPConnectionPool, at no more than rate_limit messages
+    per second if given. Failed messages are retried up to max_tries times
+    with growing delays, scheduled on timers so that no sending thread
+    waits on them. send() returns a Future of whether the message was
+    sent, and close() waits for all messages (including retries) to finish.
+    """
+
+    def __init__(
+        self,
+        smtp_server,
+        smtp_username=None,
+        smtp_password=None,
+        pool_size=4,
+        rate_limit=None,
+        max_tries=3,
+        initial_backoff=30,
+        max_backoff=600,
+    ):
+        self.smtp_server = smtp_server
+        self.pool = SMTPConnectionPool(smtp_server, smtp_username, smtp_password)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.max_tries = max_tries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._pending = 0
+        self._pending_changed = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def send(self, msg, recipients):
+        """Queues a message for sending, returns a Future of whether it was sent"""
+        future = Future()
+        with self._pending_changed:
+            self._pending += 1
+        self._executor.submit(self._send, msg, recipients, future, 1)
+        return future
+
+    def _finish(self, future, sent):
+        future.set_result(sent)
+        with self._pending_changed:
+            self._pending -= 1
+            self._pending_changed.notify_all()
+
+    def _retry(self, msg, recipients, future, tries):
+        self._executor.submit(self._send, msg, recipients, future, tries)
+
+    def _send(self, msg, recipients, future, tries):
+        self.rate_limiter.wait()
+        try:
+            result = self.pool.sendmail(msg, recipients)
+            if len(result) == 0:
+                self._finish(future, True)
+                return
+            click.echo(
+                f"Could not send email to {result} using server {self.smtp_server}",
+                err=True,
+            )
+            recipients = list(result)
+        except Exception as e:
+            click.echo(
+                f"Could not send to {recipients} using server {self.smtp_server}: {e}",
+                err=True,
+            )
+
+        if tries >= self.max_tries:
+            click.echo(f"Failed to send email after {tries} tries", err=True)
+            self._finish(future, False)
+            return
+
+        delay = min(self.initial_backoff * 1.5 ** (tries - 1), self.max_backoff)
+        timer = threading.Timer(
+            delay, self._retry, args=(msg, recipients, future, tries + 1)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def wait(self):
+        """Waits for all queued messages to be sent or to fail"""
+        with self._pending_changed:
+            while self._pending > 0:
+                self._pending_changed.wait()
+
+    def close(self):
+        """Waits for all queued messages and closes all connections"""
+        self.wait()
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+
+class MXCache:
+    """Mail exchangers per domain, in order of preference, cached for as
+    long as the TTL of their DNS records"""
+
+    def __init__(self):
+        self._mailservers = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, domain):
+        domain = domain.casefold()
+        with self._lock:
+            expiration, mailservers = self._mailservers.get(domain, (0, None))
+        if expiration > time.monotonic():
+            return mailservers
+
+        answer = dns.resolver.resolve(domain, "MX")
+        mailservers = [
+            mx.exchange.to_text().rstrip(".")
+            for mx in sorted(answer, key=lambda mx: mx.preference)
+        ]
+        with self._lock:
+            self._mailservers[domain] = (
+                time.monotonic() + answer.rrset.ttl,
+                mailservers,
+            )
+        return mailservers
+
+
+# Shared by all direct deliveries in a run
+MX_CACHE = MXCache()
+
+
+class DirectMailSender:
+    """Sends messages directly to the recipients' mail exchangers
+
+    Recipients are grouped by domain so that each message is sent to each
+    domain once, with all of that domain's recipients, and connections to
+    each mail exchanger are kept open and reused across messages. send()
+    returns a Future of whether the message reached every recipient, like
+    MailSender.send(), but sends before returning."""
+
+    def __init__(self, mx_cache=MX_CACHE):
+        self.mx_cache = mx_cache
+        self._pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def send(self, msg, recipients):
+        domain_recipients = {}
+        for recipient in recipients:
+            domain = recipient.split("@")[1].casefold()
+            domain_recipients.setdefault(domain, []).append(recipient)
+
+        failed = []
+        for domain, recipients in domain_recipients.items():
+            try:
+                mailservers = self.mx_cache.resolve(domain)
+            except Exception as e:
+                click.echo(
+                    f"ERROR: Could not look up mail exchangers for {domain}: {e}",
+                    err=True,
+                )
+                failed.extend(recipients)
+                continue
+
+            for mailserver in mailservers:
+                pool = self._pools.setdefault(
+                    mailserver, SMTPConnectionPool(mailserver)
+                )
+                try:
+                    result = pool.sendmail(msg, recipients)
+                except Exception as e:
+                    click.echo(
+                        f"WARNING: Could not send to {recipients} using {mailserver}: {e}",
+                        err=True,
+                    )
+                    continue
+                if len(result) > 0:
+                    click.echo(
+                        f"WARNING: Got result: {result} from {mailserver}", err=True
+                    )
+                    failed.extend(result)
+                break
+            else:
+                click.echo(
+                    f"ERROR: Could not send to {recipients} using any mailserver",
+                    err=True,
+                )
+                failed.extend(recipients)
+
+        future = Future()
+        future.set_result(len(failed) == 0)
+        return future
+
+    def wait(self):
+        pass
+
+    def close(self):
+        """Closes all connections"""
+        for pool in self._pools.values():
+            pool.close()
+        self._pools = {}
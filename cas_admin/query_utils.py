@@ -1,14 +1,140 @@
+import queue
+import threading
 from elasticsearch.helpers import scan
 from datetime import datetime
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+
+def search_pit_slice(
+    es_client, body, pit_id, slice_id=0, slices=1, size=1000, keep_alive="1m"
+):
+    """Returns iterator of pages of hits from one slice of a
+    point-in-time search, paginated using search_after"""
+
+    body = dict(body)
+    body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+    body["sort"] = ["_shard_doc"]
+    body["size"] = size
+    if slices > 1:
+        body["slice"] = {"id": slice_id, "max": slices}
+
+    while True:
+        result = es_client.search(body=body)
+        hits = result["hits"]["hits"]
+        if len(hits) == 0:
+            break
+        yield hits
+        if len(hits) < size:
+            break
+        body["pit"]["id"] = result.get("pit_id", body["pit"]["id"])
+        body["search_after"] = hits[-1]["sort"]
+
+
+def pit_scan(es_client, body, index, slices=4, size=1000, keep_alive="1m"):
+    """Returns iterator of hits from a sliced point-in-time search,
+    with each slice searched in its own thread"""
+
+    pit_id = es_client.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    pages = queue.Queue(maxsize=2 * slices)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run_slice(slice_id):
+        try:
+            for hits in search_pit_slice(
+                es_client, body, pit_id, slice_id, slices, size, keep_alive
+            ):
+                if not put(hits):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            try:
+                for slice_id in range(slices):
+                    executor.submit(run_slice, slice_id)
+                finished_slices = 0
+                while finished_slices < slices:
+                    hits = pages.get()
+                    if hits is None:
+                        finished_slices += 1
+                    elif isinstance(hits, Exception):
+                        raise hits
+                    else:
+                        for hit in hits:
+                            yield hit
+            finally:
+                stop.set()
+    finally:
+        es_client.close_point_in_time(body={"id": pit_id})
+
+
+def scan_query(es_client, query, slices=1):
+    """Returns iterator of hits given search arguments, using a
+    sliced point-in-time search if more than one slice is requested"""
+
+    if slices > 1:
+        return pit_scan(
+            es_client,
+            query["body"],
+            query["index"],
+            slices=slices,
+            size=query["size"],
+        )
+    query = dict(query)
+    return scan(client=es_client, query=query.pop("body"), **query)
+
+
+def composite_buckets(es_client, query, group_cols, sum_col, size=1000):
+    """Returns iterator of composite aggregation buckets of the
+    given search arguments grouped by group_cols and summed over sum_col"""
+
+    query = dict(query, size=0, body=dict(query["body"]))
+    query["body"]["aggs"] = {
+        "buckets": {
+            "composite": {
+                "size": size,
+                "sources": [
+                    {col: {"terms": {"field": col, "missing_bucket": True}}}
+                    for col in group_cols
+                ],
+            },
+            "aggs": {sum_col: {"sum": {"field": sum_col}}},
+        }
+    }
+
+    while True:
+        result = es_client.search(**query)["aggregations"]["buckets"]
+        for bucket in result["buckets"]:
+            yield bucket
+        if "after_key" not in result or len(result["buckets"]) == 0:
+            break
+        query["body"]["aggs"]["buckets"]["composite"]["after"] = result["after_key"]
 
 
 def query_charges(
-    es_client, start_date, end_date, account=None, index="cas-daily-charge-records-*"
+    es_client,
+    start_date,
+    end_date,
+    account=None,
+    index="cas-daily-charge-records-*",
+    slices=1,
+    size=1000,
 ):
     """Returns iterator of charges given a time range"""
 
-    query = {"index": index, "scroll": "30s", "size": 1000, "body": {}}
+    query = {"index": index, "scroll": "30s", "size": size, "body": {}}
 
     query["body"]["query"] = {
         "bool": {
@@ -23,19 +149,33 @@ def query_charges(
             {"term": {"account_id": account}}
         )
 
-    for doc in scan(client=es_client, query=query.pop("body"), **query):
+    for doc in scan_query(es_client, query, slices=slices):
         yield doc
 
 
-def query_usage(es_client, start_date, end_date, match_terms={}, index="path-schedd-*"):
-    """Returns iterator of usage given an account and a time range"""
+def query_usage(
+    es_client,
+    start_date,
+    end_date,
+    match_terms={},
+    filter_terms={},
+    source_includes=None,
+    after_record_times={},
+    index="path-schedd-*",
+    slices=1,
+    size=1000,
+):
+    """Returns iterator of usage given an account and a time range,
+    optionally fetching only the source_includes fields and skipping
+    ads in each index of after_record_times at or before the given
+    RecordTime"""
 
     # Convert date objects to timestamps
     date2ts = lambda d: int(datetime(d.year, d.month, d.day).timestamp())
     start_ts = date2ts(start_date)
     end_ts = date2ts(end_date)
 
-    query = {"index": index, "scroll": "30s", "size": 1000, "body": {}}
+    query = {"index": index, "scroll": "30s", "size": size, "body": {}}
 
     query["body"]["query"] = {
         "bool": {
@@ -48,11 +188,135 @@ def query_usage(es_client, start_date, end_date, match_terms={}, index="path-sch
     for attr, value in match_terms.items():
         query["body"]["query"]["bool"]["filter"].append({"match_phrase": {attr: value}})
 
-    for doc in scan(client=es_client, query=query.pop("body"), **query):
+    # Each filter term value is a list of values, any of which may match
+    for attr, values in filter_terms.items():
+        query["body"]["query"]["bool"]["filter"].append({"terms": {attr: list(values)}})
+
+    if len(after_record_times) > 0:
+        query["body"]["query"]["bool"]["should"] = [
+            {
+                "bool": {
+                    "filter": [
+                        {"term": {"_index": usage_index}},
+                        {"range": {"RecordTime": {"gt": record_time}}},
+                    ]
+                }
+            }
+            for usage_index, record_time in after_record_times.items()
+        ]
+        query["body"]["query"]["bool"]["should"].append(
+            {"bool": {"must_not": [{"terms": {"_index": list(after_record_times)}}]}}
+        )
+        query["body"]["query"]["bool"]["minimum_should_match"] = 1
+
+    if source_includes is not None:
+        query["body"]["_source"] = list(source_includes)
+
+    for doc in scan_query(es_client, query, slices=slices):
         yield doc
 
 
-def get_charge_data(
+def query_usage_buckets(
+    es_client,
+    start_date,
+    end_date,
+    group_cols,
+    sum_col="RemoteWallClockTime",
+    filter_terms={},
+    index="path-schedd-*",
+    size=1000,
+):
+    """Returns iterator of composite aggregation buckets of usage
+    grouped by the given columns and summed over sum_col"""
+
+    # Convert date objects to timestamps
+    date2ts = lambda d: int(datetime(d.year, d.month, d.day).timestamp())
+    start_ts = date2ts(start_date)
+    end_ts = date2ts(end_date)
+
+    query = {"index": index, "body": {}}
+
+    query["body"]["query"] = {
+        "bool": {
+            "filter": [
+                {"range": {"RecordTime": {"gte": start_ts, "lt": end_ts}}},
+            ]
+        }
+    }
+
+    for attr, values in filter_terms.items():
+        query["body"]["query"]["bool"]["filter"].append({"terms": {attr: list(values)}})
+
+    for bucket in composite_buckets(es_client, query, group_cols, sum_col, size):
+        yield bucket
+
+
+def query_charge_totals(
+    es_client,
+    start_date,
+    end_date,
+    index="cas-daily-charge-records-*",
+    size=1000,
+):
+    """Returns iterator of composite aggregation buckets of total
+    charges per account and charge type given a time range"""
+
+    query = {"index": index, "body": {}}
+
+    query["body"]["query"] = {
+        "bool": {
+            "filter": [
+                {"range": {"date": {"gte": str(start_date), "lt": str(end_date)}}}
+            ]
+        }
+    }
+
+    for bucket in composite_buckets(
+        es_client, query, ["account_id", "charge_type"], "total_charges", size
+    ):
+        yield bucket
+
+
+def get_charge_totals(
+    es_client,
+    start_date,
+    end_date,
+    charge_index="cas-daily-charge-records-*",
+    account_index="cas-credit-accounts",
+):
+    """Returns total charges per account and charge type"""
+
+    buckets = list(
+        query_charge_totals(es_client, start_date, end_date, index=charge_index)
+    )
+
+    # v1 charge records have no charge_type, look up all their accounts at once
+    v1_charge_functions = get_v1_charge_functions(
+        es_client,
+        [
+            bucket["key"]["account_id"]
+            for bucket in buckets
+            if bucket["key"]["charge_type"] is None
+        ],
+        account_index,
+    )
+
+    totals = {}
+    for bucket in buckets:
+        account = bucket["key"]["account_id"]
+        charge_type = bucket["key"]["charge_type"]
+        if charge_type is None:
+            charge_type = v1_charge_functions[account][0:3]
+
+        account_totals = totals.setdefault(account, {})
+        account_totals[charge_type] = (
+            account_totals.get(charge_type, 0.0) + bucket["total_charges"]["value"]
+        )
+
+    return totals
+
+
+def iter_charge_data(
     es_client,
     start_date,
     end_date,
@@ -60,39 +324,102 @@ def get_charge_data(
     addl_cols=[],
     charge_index="cas-daily-charge-records-*",
     account_index="cas-credit-accounts",
+    slices=1,
+    batch_size=10000,
 ):
-    """Returns rows of account data"""
+    """Yields rows of charge data
+
+    Rows are read in batches of batch_size so that the charge functions of
+    all v1 accounts in a batch are looked up in a single query. Charge
+    records converted by elasticsearch_templates/convert_charges_v1_to_v2.py
+    are v2 and need no lookups."""
+
+    v1_charge_functions = {}
+
+    def resolve_rows(rows):
+        # Add charge_type and charge_function to all returns
+        v1_rows = [row for row in rows if row.get("cas_version", "v1") == "v1"]
+        v1_charge_functions.update(
+            get_v1_charge_functions(
+                es_client,
+                [
+                    row["account_id"]
+                    for row in v1_rows
+                    if row["account_id"] not in v1_charge_functions
+                ],
+                account_index,
+            )
+        )
+        for row in v1_rows:
+            v1_charge_function = v1_charge_functions[row["account_id"]]
+            row["charge_type"] = v1_charge_function[0:3]
+            row["charge_function"] = v1_charge_function
+            row["cas_version"] = "v1"
+        return rows
 
     rows = []
     for charge_info in query_charges(
-        es_client, start_date, end_date, account=account, index=charge_index
+        es_client,
+        start_date,
+        end_date,
+        account=account,
+        index=charge_index,
+        slices=slices,
     ):
         row = charge_info["_source"]
 
         for col in addl_cols:
             # Do some column common calculations if add_cols is set
             # (But we don't have any yet)
-            raise ValueError(f"Unknown additional column '{column}'")
-
-        # Add charge_type and charge_function to all returns
-        if row.get("cas_version", "v1") == "v1":
-            v1_charge_function = get_v1_charge_function(
-                es_client, row["account_id"], account_index
-            )
-            v1_type = v1_charge_function[0:3]
-            row["charge_type"] = v1_type
-            row["charge_function"] = v1_charge_function
-            row["cas_version"] = "v1"
+            raise ValueError(f"Unknown additional column '{col}'")
 
         rows.append(row)
+        if len(rows) >= batch_size:
+            yield from resolve_rows(rows)
+            rows = []
 
-    return rows
+    yield from resolve_rows(rows)
 
 
-def get_usage_data(
-    es_client, start_date, end_date, match_terms={}, addl_cols=[], index="path-schedd-*"
+def get_charge_data(
+    es_client,
+    start_date,
+    end_date,
+    account=None,
+    addl_cols=[],
+    charge_index="cas-daily-charge-records-*",
+    account_index="cas-credit-accounts",
 ):
-    """Returns rows of usage data"""
+    """Returns rows of charge data"""
+
+    return list(
+        iter_charge_data(
+            es_client,
+            start_date,
+            end_date,
+            account=account,
+            addl_cols=addl_cols,
+            charge_index=charge_index,
+            account_index=account_index,
+        )
+    )
+
+
+def iter_usage_data(
+    es_client,
+    start_date,
+    end_date,
+    match_terms={},
+    filter_terms={},
+    addl_cols=[],
+    cols=None,
+    index="path-schedd-*",
+    slices=1,
+):
+    """Yields rows of usage data
+
+    If cols is given, only those columns are fetched and returned,
+    otherwise the default columns plus addl_cols are returned."""
 
     default_cols = [
         "Owner",
@@ -106,14 +433,22 @@ def get_usage_data(
         "MemoryProvisioned",
         "RequestGpus",
         "GpusProvisioned",
+        "IsHyperthreadCpu",
         "MachineAttrGLIDEIN_ResourceName0",
         "JobUniverse",
     ]
-    cols = default_cols + addl_cols
+    if cols is None:
+        cols = default_cols + addl_cols
 
-    rows = []
     for usage_info in query_usage(
-        es_client, start_date, end_date, match_terms=match_terms, index=index
+        es_client,
+        start_date,
+        end_date,
+        match_terms=match_terms,
+        filter_terms=filter_terms,
+        source_includes=cols,
+        index=index,
+        slices=slices,
     ):
         row_in = usage_info["_source"]
         row_out = {}
@@ -124,64 +459,149 @@ def get_usage_data(
             except KeyError:
                 row_out[col] = None
 
-        rows.append(row_out)
+        yield row_out
+
+
+def get_usage_data(
+    es_client,
+    start_date,
+    end_date,
+    match_terms={},
+    filter_terms={},
+    addl_cols=[],
+    cols=None,
+    index="path-schedd-*",
+):
+    """Returns rows of usage data"""
+
+    return list(
+        iter_usage_data(
+            es_client,
+            start_date,
+            end_date,
+            match_terms=match_terms,
+            filter_terms=filter_terms,
+            addl_cols=addl_cols,
+            cols=cols,
+            index=index,
+        )
+    )
+
+
+def get_usage_buckets(
+    es_client,
+    start_date,
+    end_date,
+    group_cols,
+    sum_col="RemoteWallClockTime",
+    filter_terms={},
+    index="path-schedd-*",
+):
+    """Returns rows of usage data summed over sum_col, one row per
+    unique combination of group_cols"""
+
+    rows = []
+    for bucket in query_usage_buckets(
+        es_client,
+        start_date,
+        end_date,
+        group_cols,
+        sum_col=sum_col,
+        filter_terms=filter_terms,
+        index=index,
+    ):
+        row = dict(bucket["key"])
+        row[sum_col] = bucket[sum_col]["value"]
+        row["DocCount"] = bucket["doc_count"]
+        rows.append(row)
 
     return rows
 
 
-def query_account(es_client, account=None, index="cas-credit-accounts"):
+def iter_accounts(
+    es_client, query=None, index="cas-credit-accounts", page_size=1000, keep_alive="1m"
+):
+    """Returns iterator of account hits (matching a query), paginated with
+    a point-in-time search and search_after so that no accounts are dropped
+    regardless of how many there are"""
+
+    body = {"seq_no_primary_term": True}
+    if query is not None:
+        body["query"] = query
+
+    pit_id = es_client.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    try:
+        for hits in search_pit_slice(
+            es_client, body, pit_id, size=page_size, keep_alive=keep_alive
+        ):
+            for hit in hits:
+                yield hit
+    finally:
+        es_client.close_point_in_time(body={"id": pit_id})
+
+
+def query_account(
+    es_client, account=None, index="cas-credit-accounts", page_size=1000
+):
     """Returns account(s) info"""
 
-    query = {"index": index, "size": 1000, "body": {}}
-
+    # A single account id is a cheap lookup without a point in time
     if account is not None:
+        query = {"index": index, "size": page_size, "body": {}}
+        query["body"]["seq_no_primary_term"] = True
         query["body"]["query"] = {"term": {"account_id": account}}
+        return es_client.search(**query)
+
+    hits = list(iter_accounts(es_client, index=index, page_size=page_size))
+    return {"hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits}}
+
+
+def add_account_cols(row, addl_cols=[]):
+    """Adds commonly calculated columns to a row of account data"""
+
+    for col in addl_cols:
+        if col == "remaining_cpu_credits":
+            row[col] = row["cpu_credits"] - row.get("cpu_charges", 0)
+        elif col == "remaining_gpu_credits":
+            row[col] = row["gpu_credits"] - row.get("gpu_charges", 0)
+        elif col == "percent_cpu_credits_used":
+            if row["cpu_credits"] > 1e-8:
+                row[col] = row.get("cpu_charges", 0) / row["cpu_credits"]
+            else:
+                row[col] = 0.0
+        elif col == "percent_gpu_credits_used":
+            if row["gpu_credits"] > 1e-8:
+                row[col] = row.get("gpu_charges", 0) / row["gpu_credits"]
+            else:
+                row[col] = 0.0
+        else:
+            raise ValueError(f"Unknown additional column '{col}'")
 
-    result = es_client.search(**query)
-    return result
+    return row
 
 
 def get_account_data(
-    es_client, account=None, addl_cols=[], index="cas-credit-accounts"
+    es_client, account=None, addl_cols=[], index="cas-credit-accounts", page_size=1000
 ):
     """Returns rows of account data"""
 
     rows = []
-    for account_info in query_account(es_client, account=account, index=index)["hits"][
-        "hits"
-    ]:
-        row = account_info["_source"]
-
-        for col in addl_cols:
-            # Do some column common calculations if add_cols is set
-            if col == "remaining_cpu_credits":
-                row[col] = row["cpu_credits"] - row.get("cpu_charges", 0)
-            elif col == "remaining_gpu_credits":
-                row[col] = row["gpu_credits"] - row.get("gpu_charges", 0)
-            elif col == "percent_cpu_credits_used":
-                if row["cpu_credits"] > 1e-8:
-                    row[col] = row.get("cpu_charges", 0) / row["cpu_credits"]
-                else:
-                    row[col] = 0.0
-            elif col == "percent_gpu_credits_used":
-                if row["gpu_credits"] > 1e-8:
-                    row[col] = row.get("gpu_charges", 0) / row["gpu_credits"]
-                else:
-                    row[col] = 0.0
-            else:
-                raise ValueError(f"Unknown additional column '{column}'")
-
-        rows.append(row)
+    for account_info in query_account(
+        es_client, account=account, index=index, page_size=page_size
+    )["hits"]["hits"]:
+        rows.append(add_account_cols(account_info["_source"], addl_cols))
 
     return rows
 
 
-def get_account_emails(es_client, active_since=None, index="cas-credit-accounts"):
+def get_account_emails(
+    es_client, active_since=None, index="cas-credit-accounts", page_size=1000
+):
     """Returns account ids (active since a given date)"""
 
-    query = {"index": index, "size": 1000, "body": {}}
+    query = None
     if active_since is not None:
-        query["body"]["query"] = {
+        query = {
             "bool": {
                 "should": [
                     {"range": {"cpu_last_charge_date": {"gte": str(active_since)}}},
@@ -192,7 +612,7 @@ def get_account_emails(es_client, active_since=None, index="cas-credit-accounts"
         }
 
     active_accounts = {}
-    for result in es_client.search(**query)["hits"]["hits"]:
+    for result in iter_accounts(es_client, query, index=index, page_size=page_size):
         active_accounts[result["_source"]["account_id"]] = result["_source"][
             "owner_email"
         ]
@@ -200,13 +620,32 @@ def get_account_emails(es_client, active_since=None, index="cas-credit-accounts"
     return active_accounts
 
 
-@lru_cache(maxsize=1024)
-def get_v1_charge_function(es_client, account, index="cas-credit-accounts"):
-    """Returns v1 charge function given an account"""
+def get_v1_charge_functions(es_client, accounts, index="cas-credit-accounts"):
+    """Returns v1 charge functions given accounts, looked up in one query"""
+
+    accounts = list(set(accounts))
+    v1_charge_functions = {}
+    if len(accounts) == 0:
+        return v1_charge_functions
+
+    results = es_client.search(
+        index=index,
+        body={
+            "query": {"terms": {"account_id": accounts}},
+            "size": len(accounts),
+            "_source": ["account_id", "v1_charge_function"],
+        },
+    )
+    for result in results["hits"]["hits"]:
+        if "v1_charge_function" in result["_source"]:
+            v1_charge_functions[result["_source"]["account_id"]] = result["_source"][
+                "v1_charge_function"
+            ]
 
-    query = {"index": index, "size": 1000, "body": {}}
-    query["body"]["query"] = {"term": {"account_id": account}}
+    for account in accounts:
+        if account not in v1_charge_functions:
+            raise ValueError(
+                f"No v1 charge function found for account '{account}' in index '{index}'"
+            )
 
-    for result in es_client.search(**query)["hits"]["hits"]:
-        v1_charge_function = result["_source"]["v1_charge_function"]
-    return v1_charge_function
+    return v1_charge_functions
@@ -0,0 +1,120 @@
+# Background colors of charge table cells by charge type, scaled per
+# resource type (unlisted resources use the charge type's full color)
+CHARGE_RGBS = {
+    "cpu": (255, 238, 204),
+    "gpu": (204, 238, 255),
+}
+RESOURCE_SCALES = {
+    "cpu": {
+        "cpu": 1.00,
+        "memory": 0.90,
+    },
+    "gpu": {
+        "cpu": 1.00,
+        "gpu": 0.95,
+        "memory": 0.90,
+    },
+}
+
+
+def _rgb_str(rgb, scale=1):
+    return f"rgb({', '.join(f'{scale*x:.0f}' for x in rgb)})"
+
+
+def _charge_styles():
+    """Returns the CSS class per (charge type, resource type) and per
+    charge type alone, and the stylesheet rules for those classes"""
+    charge_classes = {}
+    rules = []
+    for charge_type, rgb in CHARGE_RGBS.items():
+        charge_classes[charge_type] = charge_type
+        rules.append(f"td.{charge_type} {{ background-color: {_rgb_str(rgb)}; }}")
+        for res_type, scale in RESOURCE_SCALES.get(charge_type, {}).items():
+            css_class = f"{charge_type}-{res_type}"
+            charge_classes[(charge_type, res_type)] = css_class
+            rules.append(
+                f"td.{css_class} {{ background-color: {_rgb_str(rgb, scale)}; }}"
+            )
+    return charge_classes, rules
+
+
+CHARGE_CLASSES, _CHARGE_RULES = _charge_styles()
+
+STYLESHEET = (
+    """<style>
+body { background-color: white; }
+table { border-collapse: collapse; }
+th { text-align: center; border: 1px solid black; }
+td { text-align: left; border: 1px solid black; }
+td.num { text-align: right; }
+td.blank { border-style: none; }
+table.padded th, table.padded td { padding: 4px; }
+tr.odd { background-color: #ddd; }
+tr.even { background-color: white; }
+"""
+    + "\n".join(_CHARGE_RULES)
+    + "\n</style>\n"
+)
+
+
+def get_charge_class(charge_type=None, res_type=None):
+    """Returns the CSS class of a charge cell's background color, if any"""
+    if charge_type is None:
+        return None
+    if res_type is None:
+        res_type = charge_type
+    return CHARGE_CLASSES.get((charge_type, res_type), CHARGE_CLASSES.get(charge_type))
+
+
+def td(text, css_class=None, colspan=None):
+    """Returns a table cell"""
+    attrs = ""
+    if css_class:
+        attrs += f' class="{css_class}"'
+    if colspan is not None:
+        attrs += f' colspan="{colspan}"'
+    return f"<td{attrs}>{text}</td>"
+
+
+def value_td(value="", css_class=None):
+    """Returns a right-aligned cell for numeric values, or a left-aligned
+    cell for anything else"""
+    try:
+        value = float(value)
+    except ValueError:
+        return td(value, css_class)
+    return td(f"{value:,.1f}", f"num {css_class}" if css_class else "num")
+
+
+class HTMLReport:
+    """Collects the parts of an HTML report in a list that is joined once
+    by getvalue(), so large tables are built in linear time. Cells are
+    styled with the classes in STYLESHEET rather than inline styles."""
+
+    def __init__(self):
+        self._parts = ["<html>\n<head>\n", STYLESHEET, "</head>\n<body>\n"]
+
+    def write(self, *parts):
+        self._parts.extend(parts)
+
+    def heading(self, text):
+        self.write(f"<h1>{text}</h1>\n")
+
+    def start_table(self, padded=False):
+        self.write('<table class="padded">\n' if padded else "<table>\n")
+
+    def end_table(self):
+        self.write("</table>\n")
+
+    def row(self, cells, css_class=None):
+        """Adds a table row of already rendered cells"""
+        self.write(f'<tr class="{css_class}">\n' if css_class else "<tr>\n")
+        self._parts.extend(cells)
+        self.write("</tr>\n")
+
+    def header_row(self, column_names, css_class=None):
+        self.row((f"<th>{name}</th>" for name in column_names), css_class)
+
+    def getvalue(self):
+        """Returns the finished HTML"""
+        return "".join(self._parts) + "</body>\n</html>\n"
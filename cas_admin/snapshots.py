@@ -0,0 +1,413 @@
+import gzip
+import json
+from bisect import bisect_right
+from datetime import date
+from pathlib import Path
+from urllib.parse import quote
+
+from cas_admin.query_utils import add_account_cols
+
+
+SNAPSHOT_PREFIX = "cas-credit-accounts"
+MANIFEST_NAME = f"{SNAPSHOT_PREFIX}_manifest.json"
+ACCOUNT_INDEX_NAME = f"{SNAPSHOT_PREFIX}_account_index"
+
+
+def add_account_changes(account_changes, this_date, changed, removed, account=None):
+    """Records the dates on which accounts (or only the given account)
+    changed (with the id of the doc holding their new state) or were
+    removed (with None)"""
+    for removed_account in removed:
+        if account is None or removed_account == account:
+            account_changes.setdefault(removed_account, []).append(
+                [str(this_date), None]
+            )
+    for hit in changed:
+        if account is None or hit["_source"]["account_id"] == account:
+            account_changes.setdefault(hit["_source"]["account_id"], []).append(
+                [str(this_date), hit["_id"]]
+            )
+
+
+class SnapshotStore:
+    """Daily account snapshots stored as a compressed base snapshot of all
+    accounts followed by compressed per-day deltas of changed accounts
+
+    All snapshot dates are listed in a manifest so that finding missing
+    days only needs one file read. A new base snapshot is written after
+    base_interval deltas so that loading a day never replays too many.
+    Older uncompressed per-day snapshot files in snapshot_dir are picked up
+    as full snapshots the first time the manifest is created.
+
+    An account index records the dates on which each account changed, in
+    a small file per account, so that an account's state as of any date is
+    read from the one snapshot file that holds it. The index is kept up to
+    date as snapshots are written.
+
+    A read_only store never writes to snapshot_dir (e.g. when it is read
+    while daily snapshots are being written), snapshots written after the
+    account index was last updated are read in memory instead."""
+
+    def __init__(self, snapshot_dir, base_interval=30, read_only=False):
+        self.snapshot_dir = Path(snapshot_dir)
+        self.base_interval = base_interval
+        self.read_only = read_only
+        self._manifest = None
+        self._latest = None
+
+    @property
+    def manifest_file(self):
+        return self.snapshot_dir / MANIFEST_NAME
+
+    @property
+    def account_index_dir(self):
+        return self.snapshot_dir / ACCOUNT_INDEX_NAME
+
+    @property
+    def account_index_through_file(self):
+        return self.account_index_dir / "through.json"
+
+    def account_changes_file(self, account):
+        return self.account_index_dir / "accounts" / f"{quote(account, safe='')}.json"
+
+    def manifest(self):
+        """Returns the manifest, creating it if needed"""
+        if self._manifest is not None:
+            return self._manifest
+        if self.manifest_file.exists():
+            with self.manifest_file.open() as f:
+                self._manifest = json.load(f)
+        else:
+            self._manifest = {"snapshots": []}
+            for snapshot_file in sorted(
+                self.snapshot_dir.glob(f"{SNAPSHOT_PREFIX}_????-??-??.json")
+            ):
+                self._manifest["snapshots"].append(
+                    {
+                        "date": snapshot_file.stem.split("_")[-1],
+                        "type": "full",
+                        "file": snapshot_file.name,
+                    }
+                )
+            if len(self._manifest["snapshots"]) > 0 and not self.read_only:
+                self.save_manifest()
+        return self._manifest
+
+    def write_json(self, json_file, data, **kwargs):
+        """Replaces an uncompressed JSON file"""
+        if self.read_only:
+            raise ValueError(f"Cannot write {json_file.name}, snapshots are read only")
+        json_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = json_file.with_name(f"{json_file.name}.tmp")
+        with tmp_file.open("w") as f:
+            json.dump(data, f, **kwargs)
+        tmp_file.replace(json_file)
+
+    def save_manifest(self):
+        self.write_json(self.manifest_file, self._manifest, indent=2)
+
+    def dates(self):
+        """Returns the dates that have snapshots, in order"""
+        return [
+            date.fromisoformat(snapshot["date"])
+            for snapshot in self.manifest()["snapshots"]
+        ]
+
+    def __contains__(self, this_date):
+        return any(
+            snapshot["date"] == str(this_date)
+            for snapshot in self.manifest()["snapshots"]
+        )
+
+    def read_file(self, snapshot):
+        """Returns the contents of a snapshot's file"""
+        snapshot_file = self.snapshot_dir / snapshot["file"]
+        if snapshot["type"] == "full":
+            with snapshot_file.open() as f:
+                return json.load(f)
+        with gzip.open(snapshot_file, "rt") as f:
+            return json.load(f)
+
+    def write_file(self, file_name, data):
+        """Writes compressed data to a snapshot file"""
+        if self.read_only:
+            raise ValueError(f"Cannot write {file_name}, snapshots are read only")
+        snapshot_file = self.snapshot_dir / file_name
+        tmp_file = snapshot_file.with_name(f"{file_name}.tmp")
+        with gzip.open(tmp_file, "wt") as f:
+            json.dump(data, f, separators=(",", ":"))
+        tmp_file.replace(snapshot_file)
+
+    def iter_states(self, snapshots=None):
+        """Yields (date, {doc_id: hit}) of each snapshot by replaying
+        deltas on top of the latest earlier base, the yielded dict is
+        updated in place by the following deltas"""
+        if snapshots is None:
+            snapshots = self.manifest()["snapshots"]
+        hits = {}
+        for snapshot in snapshots:
+            data = self.read_file(snapshot)
+            if snapshot["type"] == "delta":
+                for hit in data["changed"]:
+                    hits[hit["_id"]] = hit
+                for doc_id in data["removed"]:
+                    hits.pop(doc_id, None)
+            else:
+                hits = {hit["_id"]: hit for hit in data}
+            yield date.fromisoformat(snapshot["date"]), hits
+
+    def replay(self, snapshots):
+        """Returns {doc_id: hit} of the last of the given snapshots,
+        replayed from the base snapshot before it"""
+        i_base = max(
+            i for i, snapshot in enumerate(snapshots) if snapshot["type"] != "delta"
+        )
+        hits = {}
+        for this_date, hits in self.iter_states(snapshots[i_base:]):
+            pass
+        return hits
+
+    def load(self, this_date):
+        """Returns account hits as of a snapshot date"""
+        snapshots = [
+            snapshot
+            for snapshot in self.manifest()["snapshots"]
+            if snapshot["date"] <= str(this_date)
+        ]
+        if len(snapshots) == 0 or snapshots[-1]["date"] != str(this_date):
+            raise ValueError(f"No snapshot exists for date '{this_date}'")
+        return list(self.replay(snapshots).values())
+
+    def write(self, this_date, hits, save=True):
+        """Adds a snapshot of account hits for a date after the last snapshot"""
+        snapshots = self.manifest()["snapshots"]
+        if len(snapshots) > 0 and snapshots[-1]["date"] >= str(this_date):
+            raise ValueError(
+                f"Snapshot for '{this_date}' must come after last snapshot '{snapshots[-1]['date']}'"
+            )
+
+        hits = {hit["_id"]: hit for hit in hits}
+        n_deltas = 0
+        for snapshot in reversed(snapshots):
+            if snapshot["type"] != "delta":
+                break
+            n_deltas += 1
+
+        last_hits = {}
+        if len(snapshots) > 0:
+            if self._latest is None or self._latest[0] != snapshots[-1]["date"]:
+                self._latest = (snapshots[-1]["date"], self.replay(snapshots))
+            last_hits = self._latest[1]
+        changed = [
+            hit
+            for doc_id, hit in hits.items()
+            if doc_id not in last_hits
+            or last_hits[doc_id]["_source"] != hit["_source"]
+        ]
+        removed = [doc_id for doc_id in last_hits if doc_id not in hits]
+
+        if len(snapshots) == 0 or n_deltas >= self.base_interval:
+            snapshot = {
+                "date": str(this_date),
+                "type": "base",
+                "file": f"{SNAPSHOT_PREFIX}_{this_date}.base.json.gz",
+            }
+            self.write_file(snapshot["file"], list(hits.values()))
+        else:
+            snapshot = {
+                "date": str(this_date),
+                "type": "delta",
+                "file": f"{SNAPSHOT_PREFIX}_{this_date}.delta.json.gz",
+            }
+            self.write_file(snapshot["file"], {"changed": changed, "removed": removed})
+
+        # Add to the account index if it was current, else rebuild it
+        last_date = snapshots[-1]["date"] if len(snapshots) > 0 else None
+        snapshots.append(snapshot)
+        if save:
+            self.save_manifest()
+            if self.account_index_through() == last_date:
+                account_changes = {}
+                add_account_changes(
+                    account_changes,
+                    this_date,
+                    changed,
+                    [last_hits[doc_id]["_source"]["account_id"] for doc_id in removed],
+                )
+                for account, changes in account_changes.items():
+                    self.save_account_changes(
+                        account, self.load_account_changes(account) + changes
+                    )
+                self.save_account_index_through(this_date)
+            else:
+                self.build_account_index()
+        self._latest = (str(this_date), hits)
+
+    def compact(self):
+        """Rewrites all snapshots, including older uncompressed ones, as
+        compressed bases and deltas and removes the files no longer used"""
+        old_snapshots = self.manifest()["snapshots"]
+        self._manifest = {"snapshots": []}
+        self._latest = None
+        for this_date, hits in self.iter_states(old_snapshots):
+            self.write(this_date, list(hits.values()), save=False)
+        self.save_manifest()
+
+        new_files = {snapshot["file"] for snapshot in self._manifest["snapshots"]}
+        for snapshot in old_snapshots:
+            if snapshot["file"] not in new_files:
+                (self.snapshot_dir / snapshot["file"]).unlink()
+
+    def account_index_through(self):
+        """Returns the last snapshot date in the account index, if any"""
+        if not self.account_index_through_file.exists():
+            return None
+        with self.account_index_through_file.open() as f:
+            return json.load(f)["through"]
+
+    def save_account_index_through(self, through):
+        self.write_json(self.account_index_through_file, {"through": str(through)})
+
+    def load_account_changes(self, account):
+        """Returns the stored [[date, doc_id or None], ...] of an account"""
+        account_changes_file = self.account_changes_file(account)
+        if not account_changes_file.exists():
+            return []
+        with account_changes_file.open() as f:
+            return json.load(f)
+
+    def save_account_changes(self, account, changes):
+        self.write_json(
+            self.account_changes_file(account), changes, separators=(",", ":")
+        )
+
+    def iter_changes(self, snapshots, sources=None):
+        """Yields (date, changed hits, removed account ids) of each snapshot
+        given {doc_id: source} as of the snapshot before the first"""
+        if sources is None:
+            sources = {}
+        for snapshot in snapshots:
+            data = self.read_file(snapshot)
+            if snapshot["type"] == "delta":
+                changed = data["changed"]
+                removed = data["removed"]
+            else:
+                changed = [
+                    hit for hit in data if sources.get(hit["_id"]) != hit["_source"]
+                ]
+                doc_ids = {hit["_id"] for hit in data}
+                removed = [doc_id for doc_id in sources if doc_id not in doc_ids]
+            removed_accounts = [sources.pop(doc_id)["account_id"] for doc_id in removed]
+            for hit in changed:
+                sources[hit["_id"]] = hit["_source"]
+            yield snapshot["date"], changed, removed_accounts
+
+    def build_account_index(self):
+        """(Re)builds the account index in one pass over the snapshots"""
+        account_changes = {}
+        snapshots = self.manifest()["snapshots"]
+        for this_date, changed, removed in self.iter_changes(snapshots):
+            add_account_changes(account_changes, this_date, changed, removed)
+        for account, changes in account_changes.items():
+            self.save_account_changes(account, changes)
+        if len(snapshots) > 0:
+            self.save_account_index_through(snapshots[-1]["date"])
+
+    def account_changes(self, account):
+        """Returns [[date, doc_id or None], ...] of the dates on which an
+        account changed, from the account index plus any later snapshots"""
+        snapshots = self.manifest()["snapshots"]
+        through = self.account_index_through()
+        if through is None:
+            indexed, later = [], snapshots
+            changes = []
+        else:
+            indexed = [
+                snapshot for snapshot in snapshots if snapshot["date"] <= through
+            ]
+            later = [snapshot for snapshot in snapshots if snapshot["date"] > through]
+            changes = self.load_account_changes(account)
+        if len(later) == 0:
+            return changes
+
+        sources = {}
+        if len(indexed) > 0:
+            sources = {
+                doc_id: hit["_source"] for doc_id, hit in self.replay(indexed).items()
+            }
+        account_changes = {account: changes}
+        for this_date, changed, removed in self.iter_changes(later, sources):
+            add_account_changes(account_changes, this_date, changed, removed, account)
+        return changes
+
+    def latest_date(self, as_of):
+        """Returns the date of the last snapshot on or before a date"""
+        dates = [str(this_date) for this_date in self.dates()]
+        i = bisect_right(dates, str(as_of)) - 1
+        if i < 0:
+            return None
+        return date.fromisoformat(dates[i])
+
+    def get_account_hit(self, account, as_of, read_file=None, account_changes=None):
+        """Returns an account's hit as of a date, reading only the snapshot
+        file from the day it last changed, or None if it did not exist"""
+        if read_file is None:
+            read_file = self.read_file
+        if account_changes is None:
+            account_changes = self.account_changes(account)
+        change_dates = [change_date for change_date, doc_id in account_changes]
+        i = bisect_right(change_dates, str(as_of)) - 1
+        if i < 0 or account_changes[i][1] is None:
+            return None
+        change_date, doc_id = account_changes[i]
+
+        for snapshot in self.manifest()["snapshots"]:
+            if snapshot["date"] == change_date:
+                break
+        data = read_file(snapshot)
+        if snapshot["type"] == "delta":
+            data = data["changed"]
+        for hit in data:
+            if hit["_id"] == doc_id:
+                return hit
+        raise ValueError(
+            f"Account index is inconsistent, no doc '{doc_id}' in {snapshot['file']}"
+        )
+
+    def get_account_data(self, as_of, account=None, addl_cols=[]):
+        """Returns rows of account data as of a date"""
+        if account is not None:
+            hit = self.get_account_hit(account, as_of)
+            hits = [hit] if hit is not None else []
+        else:
+            latest_date = self.latest_date(as_of)
+            hits = self.load(latest_date) if latest_date is not None else []
+        return [add_account_cols(dict(hit["_source"]), addl_cols) for hit in hits]
+
+    def iter_account_history(self, account, start_date, end_date, addl_cols=[]):
+        """Yields (date, row of account data or None) for each snapshot
+        date in a date range, reading each needed snapshot file once"""
+        last_data = {}
+
+        def read_file(snapshot):
+            if last_data.get("file") != snapshot["file"]:
+                last_data["file"] = snapshot["file"]
+                last_data["data"] = self.read_file(snapshot)
+            return last_data["data"]
+
+        account_changes = self.account_changes(account)
+        change_dates = {change_date for change_date, doc_id in account_changes}
+        hit = self.get_account_hit(account, start_date, read_file, account_changes)
+        for this_date in self.dates():
+            if this_date < start_date:
+                continue
+            if this_date > end_date:
+                break
+            if str(this_date) in change_dates:
+                hit = self.get_account_hit(
+                    account, this_date, read_file, account_changes
+                )
+            row = None
+            if hit is not None:
+                row = add_account_cols(dict(hit["_source"]), addl_cols)
+            yield this_date, row
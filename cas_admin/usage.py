@@ -1,17 +1,30 @@
 import click
 import sys
-from datetime import timedelta
+import json
+from datetime import date, timedelta
 from collections import OrderedDict
 from operator import itemgetter
-from elasticsearch.helpers import bulk
 
 from cas_admin.query_utils import (
-    get_account_data,
     get_charge_data,
-    get_usage_data,
+    get_charge_totals,
+    get_usage_buckets,
+    iter_usage_data,
+    query_usage,
 )
+from cas_admin.bulk_utils import BulkWriter, update_accounts
+from cas_admin.account_cache import AccountCache
 import cas_admin.cost_functions as cost_functions
 
+CHARGE_ENGINES = ["per_account", "single_scan", "composite"]
+
+# Job ad attributes needed to attribute charges to users and job types,
+# cost functions declare the rest of the attributes they need
+USAGE_KEY_COLS = ["Owner", "ScheddName", "RequestGpus"]
+
+# Number of job ads to hold in memory before charging them in batches
+USAGE_BATCH_SIZE = 10000
+
 
 def display_charges(
     es_client,
@@ -146,6 +159,173 @@ def get_job_type(job):
     return "cpu"
 
 
+def get_usage_cols(funcnames):
+    """Returns the job ad attributes needed to compute charges
+    with the given cost functions"""
+
+    cols = list(USAGE_KEY_COLS)
+    for funcname in sorted(set(funcnames)):
+        for col in getattr(cost_functions, funcname).inputs:
+            if col not in cols:
+                cols.append(col)
+    return cols
+
+
+def get_cost_funcnames(account_info):
+    """Returns the cost function name for each job type of an account"""
+    return {
+        "cpu": account_info["cpu_charge_function"],
+        "gpu": account_info["gpu_charge_function"],
+    }
+
+
+def add_usage_charges(account, account_charges, cost_funcname, usage_row):
+    """Adds the charges from a single job ad to an account's charges"""
+
+    job_type = get_job_type(usage_row)
+    cost_function = getattr(cost_functions, cost_funcname[job_type])
+
+    user = f"{usage_row.get('Owner', 'UNKNOWN')}@{usage_row.get('ScheddName', 'UNKNOWN')}"
+    user_charges = account_charges[job_type].get(user, {})
+
+    resource_charges = cost_function(usage_row)
+    for resource_name, resource_charge in resource_charges.items():
+        if resource_charge < 0:
+            click.echo(
+                f"WARNING: Negative cost computed for account {account} with usage from following job ad, ignoring:\n{usage_row}",
+                err=True,
+            )
+        user_charges[resource_name] = (
+            user_charges.get(resource_name, 0.0) + resource_charge
+        )
+    account_charges[job_type][user] = user_charges
+
+
+def add_usage_batch_charges(account, account_charges, cost_funcname, usage_rows):
+    """Adds the charges from a list of job ads to an account's charges,
+    using the cost functions' batch functions when available"""
+
+    job_type_rows = {
+        "cpu": [],
+        "gpu": [],
+    }
+    for usage_row in usage_rows:
+        job_type_rows[get_job_type(usage_row)].append(usage_row)
+
+    for job_type, job_rows in job_type_rows.items():
+        if len(job_rows) == 0:
+            continue
+        cost_function = getattr(cost_functions, cost_funcname[job_type])
+        if not hasattr(cost_function, "batch"):
+            for usage_row in job_rows:
+                add_usage_charges(account, account_charges, cost_funcname, usage_row)
+            continue
+
+        columns = {
+            col: [usage_row.get(col) for usage_row in job_rows]
+            for col in cost_function.inputs
+        }
+        users = [
+            f"{usage_row.get('Owner', 'UNKNOWN')}@{usage_row.get('ScheddName', 'UNKNOWN')}"
+            for usage_row in job_rows
+        ]
+
+        resource_charges = cost_function.batch(columns)
+        for resource_name, resource_charge_array in resource_charges.items():
+            for usage_row, user, resource_charge in zip(
+                job_rows, users, resource_charge_array.tolist()
+            ):
+                if resource_charge < 0:
+                    click.echo(
+                        f"WARNING: Negative cost computed for account {account} with usage from following job ad, ignoring:\n{usage_row}",
+                        err=True,
+                    )
+                user_charges = account_charges[job_type].setdefault(user, {})
+                user_charges[resource_name] = (
+                    user_charges.get(resource_name, 0.0) + resource_charge
+                )
+
+
+def get_charge_docs(account, date, account_charges, cost_funcname, charge_index):
+    """Returns charge docs to be indexed given an account's charges"""
+
+    account_charge_docs = []
+    for job_type in ["cpu", "gpu"]:
+        for user, user_charges in account_charges[job_type].items():
+            for resource_name, resource_charge in user_charges.items():
+                doc_source = {
+                    "account_id": account,
+                    "charge_type": job_type,
+                    "charge_function": cost_funcname[job_type],
+                    "date": str(date),
+                    "user_id": user,
+                    "resource_name": resource_name,
+                    "total_charges": resource_charge,
+                    "cas_version": "v2",
+                }
+                doc_id = f"{account}#{date}#{user}#{job_type}#{resource_name}"
+                account_charge_docs.append(
+                    {"_index": charge_index, "_id": doc_id, "_source": doc_source}
+                )
+    return account_charge_docs
+
+
+def queue_charge_docs(writer, account, account_charge_docs, dry_run=False):
+    """Queues an account's charge docs for upload"""
+
+    if not dry_run:
+        for charge_doc in account_charge_docs:
+            writer.add(account, charge_doc)
+    else:
+        click.echo(
+            f"Dry run, not indexing {len(account_charge_docs)} new charges for account {account}."
+        )
+
+
+def close_charge_writer(writer, charge_index):
+    """Uploads all queued charge docs and reports failures per account,
+    returns the ids of the charge docs that failed"""
+
+    success_count, errors = writer.close()
+    failed_doc_ids = set()
+    for account, error_infos in errors.items():
+        click.echo(
+            f"Failed to add {len(error_infos)} charges in index '{charge_index}' for account {account}:",
+            err=True,
+        )
+        for i, error_info in enumerate(error_infos, start=1):
+            click.echo(f"\t{i}. {error_info}", err=True)
+            failed_doc_ids.add(next(iter(error_info.values())).get("_id"))
+    return failed_doc_ids
+
+
+class UsageBatches:
+    """Holds job ads per key (e.g. per account) and charges them in a batch
+    per key with charge_rows(key, rows) whenever max_rows ads are held in
+    total, so that memory use does not grow with the number of keys"""
+
+    def __init__(self, charge_rows, max_rows=USAGE_BATCH_SIZE):
+        self.charge_rows = charge_rows
+        self.max_rows = max_rows
+        self.rows = {}
+        self.n_rows = 0
+
+    def add(self, key, row):
+        self.rows.setdefault(key, []).append(row)
+        self.n_rows += 1
+        if self.n_rows >= self.max_rows:
+            self.flush()
+
+    def flush(self, key=None):
+        """Charges the held ads of a key, or of all keys"""
+        keys = list(self.rows) if key is None else [key]
+        for key in keys:
+            rows = self.rows.pop(key, [])
+            if len(rows) > 0:
+                self.n_rows -= len(rows)
+                self.charge_rows(key, rows)
+
+
 def compute_daily_charges(
     es_client,
     date,
@@ -154,88 +334,368 @@ def compute_daily_charges(
     charge_index="cas-daily-charge-records",
     account_name_attr="ProjectName",
     dry_run=False,
+    engine="per_account",
+    scan_slices=1,
+    writer=None,
+    account_cache=None,
 ):
-    """Computes charges given a time range"""
-
-    account_data = get_account_data(es_client, index=account_index)
+    """Computes charges given a time range
+
+    The "per_account" engine runs one usage query per account, while the
+    "single_scan" engine scans the day's usage once for all known accounts
+    and routes each job ad to its account in memory. The "composite" engine
+    has Elasticsearch sum RemoteWallClockTime per account, user, and the
+    other cost function inputs and applies the cost function once per
+    bucket, which needs account_name_attr, Owner and ScheddName to be
+    keyword fields in the usage indices. Its charges match the per-ad
+    engines up to floating point summation order, given cost functions
+    that are linear in RemoteWallClockTime. Only the job ad attributes
+    declared by the accounts' cost functions are fetched. Usage scans are
+    split across scan_slices parallel point-in-time slices if greater than
+    one. Charge docs from all accounts are uploaded through a single
+    BulkWriter. Accounts are read from account_cache if given so that a
+    run only loads them once."""
+
+    if engine not in CHARGE_ENGINES:
+        raise ValueError(f"Unknown charge engine '{engine}'")
+    if writer is None:
+        writer = BulkWriter(es_client)
+
+    if account_cache is None:
+        account_cache = AccountCache(es_client, account_index)
+    account_data = account_cache.get_account_data()
 
     if len(account_data) == 0:
         click.echo(f"ERROR: No accounts found in index '{account_index}'", err=True)
         sys.exit(1)
 
+    cost_funcnames = {}
+    charges = {}
     for account_info in account_data:
         account = account_info["account_id"]
-        cost_funcname = {
-            "cpu": account_info["cpu_charge_function"],
-            "gpu": account_info["gpu_charge_function"],
-        }
-        account_charges = {
+        cost_funcnames[account] = get_cost_funcnames(account_info)
+        charges[account] = {
             "cpu": {},
             "gpu": {},
         }
 
-        match_terms = {account_name_attr: account}
-        for usage_row in get_usage_data(
+    usage_cols = get_usage_cols(
+        funcname
+        for account_funcnames in cost_funcnames.values()
+        for funcname in account_funcnames.values()
+    )
+
+    usage_batches = UsageBatches(
+        lambda account, rows: add_usage_batch_charges(
+            account, charges[account], cost_funcnames[account], rows
+        )
+    )
+
+    if engine == "single_scan":
+        for usage_row in iter_usage_data(
             es_client,
             date,
             date + timedelta(days=1),
-            match_terms=match_terms,
+            filter_terms={account_name_attr: list(charges)},
+            cols=[account_name_attr] + usage_cols,
             index=usage_index,
+            slices=scan_slices,
         ):
-            job_type = get_job_type(usage_row)
-            cost_function = getattr(cost_functions, cost_funcname[job_type])
+            account = usage_row[account_name_attr]
+            if account not in charges:
+                continue
+            usage_batches.add(account, usage_row)
 
-            user = f"{usage_row.get('Owner', 'UNKNOWN')}@{usage_row.get('ScheddName', 'UNKNOWN')}"
-            user_charges = account_charges[job_type].get(user, {})
+    if engine == "composite":
+        for usage_row in get_usage_buckets(
+            es_client,
+            date,
+            date + timedelta(days=1),
+            [account_name_attr]
+            + [col for col in usage_cols if col != "RemoteWallClockTime"],
+            filter_terms={account_name_attr: list(charges)},
+            index=usage_index,
+        ):
+            account = usage_row[account_name_attr]
+            if account not in charges:
+                continue
+            usage_batches.add(account, usage_row)
+
+    for account, account_charges in charges.items():
+        if engine == "per_account":
+            match_terms = {account_name_attr: account}
+            for usage_row in iter_usage_data(
+                es_client,
+                date,
+                date + timedelta(days=1),
+                match_terms=match_terms,
+                cols=usage_cols,
+                index=usage_index,
+                slices=scan_slices,
+            ):
+                usage_batches.add(account, usage_row)
+        usage_batches.flush(account)
+
+        account_charge_docs = get_charge_docs(
+            account, date, account_charges, cost_funcnames[account], charge_index
+        )
+        queue_charge_docs(writer, account, account_charge_docs, dry_run)
 
-            resource_charges = cost_function(usage_row)
-            for resource_name, resource_charge in resource_charges.items():
-                if resource_charge < 0:
-                    click.echo(
-                        f"WARNING: Negative cost computed for account {account} with usage from following job ad, ignoring:\n{usage_row}",
-                        err=True,
-                    )
-                user_charges[resource_name] = (
-                    user_charges.get(resource_name, 0.0) + resource_charge
-                )
-            account_charges[job_type][user] = user_charges
+    close_charge_writer(writer, charge_index)
 
-        # Create charge docs
-        account_charge_docs = []
-        for job_type in ["cpu", "gpu"]:
-            for user, user_charges in account_charges[job_type].items():
-                for resource_name, resource_charge in user_charges.items():
-                    doc_source = {
-                        "account_id": account,
-                        "charge_type": job_type,
-                        "charge_function": cost_funcname[job_type],
-                        "date": str(date),
-                        "user_id": user,
-                        "resource_name": resource_name,
-                        "total_charges": resource_charge,
-                        "cas_version": "v2",
-                    }
-                    doc_id = f"{account}#{date}#{user}#{job_type}#{resource_name}"
-                    account_charge_docs.append(
-                        {"_index": charge_index, "_id": doc_id, "_source": doc_source}
-                    )
 
-        # Upload charges
-        if not dry_run:
-            success_count, error_infos = bulk(
-                es_client, account_charge_docs, raise_on_error=False, refresh="wait_for"
+def compute_charges_for_dates(
+    es_client,
+    dates,
+    account_index="cas-credit-accounts",
+    usage_index="path-schedd-*",
+    charge_index="cas-daily-charge-records",
+    account_name_attr="ProjectName",
+    dry_run=False,
+    scan_slices=1,
+    writer=None,
+    account_cache=None,
+):
+    """Computes charges for several days from a single usage scan
+
+    The usage from the first to the last of the given dates is scanned
+    once and partitioned by day using each job ad's RecordTime, then
+    each day's charges are indexed in order."""
+
+    dates = sorted(dates)
+    if len(dates) == 0:
+        return
+    if writer is None:
+        writer = BulkWriter(es_client)
+
+    if account_cache is None:
+        account_cache = AccountCache(es_client, account_index)
+    account_data = account_cache.get_account_data()
+
+    if len(account_data) == 0:
+        click.echo(f"ERROR: No accounts found in index '{account_index}'", err=True)
+        sys.exit(1)
+
+    cost_funcnames = {}
+    for account_info in account_data:
+        cost_funcnames[account_info["account_id"]] = get_cost_funcnames(account_info)
+
+    charges = {}
+    for this_date in dates:
+        charges[this_date] = {}
+        for account in cost_funcnames:
+            charges[this_date][account] = {
+                "cpu": {},
+                "gpu": {},
+            }
+
+    usage_cols = get_usage_cols(
+        funcname
+        for account_funcnames in cost_funcnames.values()
+        for funcname in account_funcnames.values()
+    )
+
+    def charge_usage_rows(date_account, rows):
+        this_date, account = date_account
+        add_usage_batch_charges(
+            account, charges[this_date][account], cost_funcnames[account], rows
+        )
+
+    usage_batches = UsageBatches(charge_usage_rows)
+
+    for usage_row in iter_usage_data(
+        es_client,
+        dates[0],
+        dates[-1] + timedelta(days=1),
+        filter_terms={account_name_attr: list(cost_funcnames)},
+        cols=[account_name_attr, "RecordTime"] + usage_cols,
+        index=usage_index,
+        slices=scan_slices,
+    ):
+        account = usage_row[account_name_attr]
+        this_date = date.fromtimestamp(usage_row["RecordTime"])
+        if account not in cost_funcnames or this_date not in charges:
+            continue
+        usage_batches.add((this_date, account), usage_row)
+
+    for this_date in dates:
+        for account, account_charges in charges[this_date].items():
+            usage_batches.flush((this_date, account))
+
+            account_charge_docs = get_charge_docs(
+                account,
+                this_date,
+                account_charges,
+                cost_funcnames[account],
+                charge_index,
             )
-            if len(error_infos) > 0:
-                click.echo(
-                    f"Failed to add {len(error_infos)} charges in index '{charge_index}' for account {account}:",
-                    err=True,
-                )
-                for i, error_info in enumerate(error_infos, start=1):
-                    click.echo(f"\t{i}. {error_info}", err=True)
-        else:
-            click.echo(
-                f"Dry run, not indexing {len(account_charge_docs)} new charges for account {account}."
+            queue_charge_docs(writer, account, account_charge_docs, dry_run)
+
+    close_charge_writer(writer, charge_index)
+
+
+def load_watermarks(watermark_file, date):
+    """Returns the RecordTime watermark per usage index for a day, and the
+    charges per charge doc already added from after those watermarks"""
+
+    if not watermark_file.exists():
+        return {}, {}
+    with watermark_file.open() as f:
+        watermarks = json.load(f)
+    if watermarks.get("date") != str(date):
+        return {}, {}
+    return watermarks["watermarks"], watermarks.get("applied_charges", {})
+
+
+def save_watermarks(watermark_file, date, watermarks, applied_charges={}):
+    """Persists the RecordTime watermark per usage index for a day, and the
+    charges per charge doc already added from after those watermarks"""
+
+    tmp_file = watermark_file.with_name(f"{watermark_file.name}.tmp")
+    with tmp_file.open("w") as f:
+        json.dump(
+            {
+                "date": str(date),
+                "watermarks": watermarks,
+                "applied_charges": applied_charges,
+            },
+            f,
+            indent=2,
+        )
+    tmp_file.replace(watermark_file)
+
+
+def compute_incremental_charges(
+    es_client,
+    date,
+    watermark_file,
+    account_index="cas-credit-accounts",
+    usage_index="path-schedd-*",
+    charge_index="cas-daily-charge-records",
+    account_name_attr="ProjectName",
+    dry_run=False,
+    scan_slices=1,
+    writer=None,
+    account_cache=None,
+):
+    """Computes charges from job ads added since the last run and adds
+    them to the day's charge records
+
+    The highest RecordTime seen in each usage index is persisted in
+    watermark_file so that each run only processes newer ads. Ads that are
+    indexed late with a RecordTime at or before their index's watermark
+    are therefore skipped until compute_daily_charges recomputes the day.
+    If any charges fail, the watermarks are not moved and the charges that
+    were added are kept in watermark_file, so the next run (which scans
+    the same ads and more) only adds the difference. This should only be
+    run for the current day, since compute_daily_charges overwrites a
+    day's charge records with its full totals."""
+
+    if writer is None:
+        writer = BulkWriter(es_client)
+
+    if account_cache is None:
+        account_cache = AccountCache(es_client, account_index)
+    account_data = account_cache.get_account_data()
+
+    if len(account_data) == 0:
+        click.echo(f"ERROR: No accounts found in index '{account_index}'", err=True)
+        sys.exit(1)
+
+    cost_funcnames = {}
+    charges = {}
+    for account_info in account_data:
+        account = account_info["account_id"]
+        cost_funcnames[account] = get_cost_funcnames(account_info)
+        charges[account] = {
+            "cpu": {},
+            "gpu": {},
+        }
+
+    usage_cols = get_usage_cols(
+        funcname
+        for account_funcnames in cost_funcnames.values()
+        for funcname in account_funcnames.values()
+    )
+    cols = [account_name_attr, "RecordTime"] + usage_cols
+
+    watermarks, applied_charges = load_watermarks(watermark_file, date)
+    new_watermarks = dict(watermarks)
+
+    usage_batches = UsageBatches(
+        lambda account, rows: add_usage_batch_charges(
+            account, charges[account], cost_funcnames[account], rows
+        )
+    )
+
+    for usage_info in query_usage(
+        es_client,
+        date,
+        date + timedelta(days=1),
+        filter_terms={account_name_attr: list(charges)},
+        source_includes=cols,
+        after_record_times=watermarks,
+        index=usage_index,
+        slices=scan_slices,
+    ):
+        usage_row = {col: usage_info["_source"].get(col) for col in cols}
+        new_watermarks[usage_info["_index"]] = max(
+            new_watermarks.get(usage_info["_index"], 0), usage_row["RecordTime"]
+        )
+        account = usage_row[account_name_attr]
+        if account not in charges:
+            continue
+        usage_batches.add(account, usage_row)
+
+    # Add the new charges to existing charge records, creating them if
+    # needed, less any charges a failed run already added from these ads
+    new_charges = {}
+    for account, account_charges in charges.items():
+        usage_batches.flush(account)
+        account_charge_docs = []
+        for charge_doc in get_charge_docs(
+            account, date, account_charges, cost_funcnames[account], charge_index
+        ):
+            new_charges[charge_doc["_id"]] = charge_doc["_source"]["total_charges"]
+            charge_doc["_source"]["total_charges"] -= applied_charges.get(
+                charge_doc["_id"], 0.0
             )
+            account_charge_docs.append(
+                {
+                    "_op_type": "update",
+                    "_index": charge_doc["_index"],
+                    "_id": charge_doc["_id"],
+                    "script": {
+                        "source": "ctx._source.total_charges += params.total_charges",
+                        "lang": "painless",
+                        "params": {
+                            "total_charges": charge_doc["_source"]["total_charges"]
+                        },
+                    },
+                    "upsert": charge_doc["_source"],
+                }
+            )
+        if len(account_charge_docs) == 0:
+            continue
+        queue_charge_docs(writer, account, account_charge_docs, dry_run)
+
+    # Only move the watermarks forward if all charges were recorded,
+    # otherwise remember what has been added since the old watermarks
+    failed_doc_ids = close_charge_writer(writer, charge_index)
+    if dry_run:
+        click.echo(f"Dry run, not writing watermarks to {watermark_file}")
+    elif len(failed_doc_ids) > 0:
+        for doc_id, doc_charges in new_charges.items():
+            if doc_id not in failed_doc_ids:
+                applied_charges[doc_id] = doc_charges
+        save_watermarks(watermark_file, date, watermarks, applied_charges)
+        click.echo(
+            f"ERROR: Not updating watermarks in {watermark_file} due to failed charges",
+            err=True,
+        )
+        sys.exit(1)
+    else:
+        save_watermarks(watermark_file, date, new_watermarks)
 
 
 def apply_daily_charges(
@@ -244,17 +704,24 @@ def apply_daily_charges(
     account_index="cas-credit-accounts",
     charge_index="cas-daily-charge-records",
     dry_run=False,
+    writer=None,
+    account_cache=None,
 ):
-    """Applies daily charges to credit accounts."""
+    """Applies daily charges to credit accounts. Applied updates are also
+    made to account_cache if given, unless an account was changed by
+    something else in the meantime, in which case the cache is dropped."""
 
-    updated_account_docs = {}
+    if writer is None:
+        writer = BulkWriter(es_client)
 
     # Load current account data
     account_infos = {}
-    for account_info in get_account_data(es_client, index=account_index):
+    if account_cache is None:
+        account_cache = AccountCache(es_client, account_index)
+    for account_info in account_cache.get_account_data():
         account_infos[account_info["account_id"]] = account_info
 
-    charge_data = get_charge_data(
+    charge_totals = get_charge_totals(
         es_client,
         date,
         date + timedelta(days=1),
@@ -262,10 +729,8 @@ def apply_daily_charges(
         account_index=account_index,
     )
 
-    updated_accounts = {}
-    for charge_info in charge_data:
-        account = charge_info["account_id"]
-        charge_type = charge_info["charge_type"]
+    account_updates = {}
+    for account, account_charge_totals in charge_totals.items():
         if account not in account_infos:
             click.echo(
                 f"WARNING: No account '{account}' found in index '{account_index}', skipping applying charges",
@@ -273,26 +738,34 @@ def apply_daily_charges(
             )
             continue
 
-        if account not in updated_accounts:
-            updated_accounts[account] = account_infos[account]
+        account_update = {"increments": {}, "sets": {}}
+        for charge_type, total_charges in account_charge_totals.items():
+            account_update["increments"][f"{charge_type}_charges"] = total_charges
+            account_update["sets"][f"{charge_type}_last_charge_date"] = str(date)
+        account_updates[account] = account_update
 
-        updated_accounts[account][f"{charge_type}_charges"] += charge_info[
-            "total_charges"
-        ]
-        updated_accounts[account][f"{charge_type}_last_charge_date"] = str(date)
-
-    updated_account_docs = []
-    for account, updated_account in updated_accounts.items():
-        doc_id = account
-        updated_account_docs.append(
-            {"_index": account_index, "_id": doc_id, "_source": updated_account}
-        )
-
-    # Do a bulk upload.
+    # Do a bulk update.
     if not dry_run:
-        success_count, error_infos = bulk(
-            es_client, updated_account_docs, raise_on_error=False, refresh="wait_for"
+        conflicts = set()
+        success_count, errors = update_accounts(
+            es_client,
+            account_index,
+            account_updates,
+            versions=account_cache.versions(account_updates),
+            writer=writer,
+            on_conflict=conflicts.add,
         )
+        if len(conflicts) > 0:
+            account_cache.invalidate()
+        else:
+            for account, account_update in account_updates.items():
+                if account not in errors:
+                    account_cache.update(account, account_update)
+        error_infos = [
+            error_info
+            for account_error_infos in errors.values()
+            for error_info in account_error_infos
+        ]
         if len(error_infos) > 0:
             click.echo(
                 f"Failed to update {len(error_infos)} accounts in index '{account_index}':",
@@ -301,6 +774,4 @@ def apply_daily_charges(
             for i, error_info in enumerate(error_infos, start=1):
                 click.echo(f"\t{i}. {error_info}", err=True)
     else:
-        click.echo(
-            f"Dry run, not indexing {len(updated_account_docs)} updated accounts."
-        )
+        click.echo(f"Dry run, not indexing {len(account_updates)} updated accounts.")
@@ -0,0 +1,78 @@
+from cas_admin.connect import connect
+from cas_admin.query_utils import iter_accounts
+from elasticsearch.helpers import bulk
+from datetime import date
+from time import time
+import os
+
+
+BENCHMARK_INDEX_PREFIX = os.environ.get(
+    "CAS_BENCHMARK_INDEX_PREFIX", "benchmark-cas-credit-accounts"
+)
+ACCOUNT_COUNTS = [10_000, 100_000]
+PAGE_SIZES = [1000, 5000, 10000]
+
+
+def generate_account_docs(index, n_accounts):
+    for i in range(n_accounts):
+        account = f"benchmark_account_{i:06d}"
+        yield {
+            "_index": index,
+            "_id": account,
+            "_source": {
+                "account_id": account,
+                "owner": f"Owner {i}",
+                "owner_email": f"owner{i}@localhost",
+                "owner_project": "benchmark",
+                "cpu_charge_function": "cpu_2022",
+                "cpu_credits": 1000.0,
+                "cpu_charges": 0.0,
+                "cpu_last_credit_date": str(date.today()),
+                "gpu_charge_function": "gpu_2022",
+                "gpu_credits": 100.0,
+                "gpu_charges": 0.0,
+                "gpu_last_credit_date": str(date.today()),
+                "cas_version": "v2",
+            },
+        }
+
+
+def create_benchmark_index(es, index, n_accounts):
+    es.indices.create(index=index, body={"settings": {"number_of_replicas": 0}})
+    bulk(es, generate_account_docs(index, n_accounts), chunk_size=5000)
+    es.indices.refresh(index=index)
+
+
+def time_single_search(es, index):
+    start = time()
+    n_hits = len(es.search(index=index, size=1000)["hits"]["hits"])
+    return n_hits, time() - start
+
+
+def time_iter_accounts(es, index, page_size):
+    start = time()
+    n_hits = sum(1 for hit in iter_accounts(es, index=index, page_size=page_size))
+    return n_hits, time() - start
+
+
+def main():
+    es = connect()
+
+    for n_accounts in ACCOUNT_COUNTS:
+        index = f"{BENCHMARK_INDEX_PREFIX}-{n_accounts}"
+        print(f"Indexing {n_accounts} accounts into {index}")
+        try:
+            create_benchmark_index(es, index, n_accounts)
+            n_hits, elapsed = time_single_search(es, index)
+            print(f"  single search (size=1000): {n_hits} accounts in {elapsed:.2f}s")
+            for page_size in PAGE_SIZES:
+                n_hits, elapsed = time_iter_accounts(es, index, page_size)
+                print(
+                    f"  iter_accounts (page_size={page_size}): {n_hits} accounts in {elapsed:.2f}s"
+                )
+        finally:
+            es.indices.delete(index=index, ignore_unavailable=True)
+
+
+if __name__ == "__main__":
+    main()
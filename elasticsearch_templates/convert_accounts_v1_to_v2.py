@@ -1,4 +1,5 @@
 from cas_admin.connect import connect
+from cas_admin.query_utils import iter_accounts
 from datetime import date
 from time import time
 from pprint import pprint
@@ -15,7 +16,7 @@ DRY_RUN = True
 
 def get_v1_docs(es, index):
     docs = {}
-    for result in es.search(index=index, size=1024)["hits"]["hits"]:
+    for result in iter_accounts(es, index=index):
         doc_id = result["_id"]
         docs[doc_id] = result["_source"]
     return docs
@@ -0,0 +1,180 @@
+import click
+import sys
+import json
+import time
+from pathlib import Path
+from cas_admin.connect import connect
+from cas_admin.query_utils import iter_accounts
+
+
+# Fills in the fields that v1 charge records lack from their account's
+# v1 charge function, the same way the read path in query_utils does
+CONVERT_CHARGE_SCRIPT = """
+def charge_function = params.charge_functions[ctx._source.account_id];
+if (charge_function == null) {
+    ctx.op = 'noop';
+    return;
+}
+ctx._source.charge_type = charge_function.substring(0, 3);
+ctx._source.charge_function = charge_function;
+ctx._source.cas_version = 'v2';
+"""
+
+
+def get_v1_charge_functions(es, account_index):
+    """Returns the v1 charge function of every converted v1 account"""
+    v1_charge_functions = {}
+    query = {"exists": {"field": "v1_charge_function"}}
+    for result in iter_accounts(es, query, index=account_index):
+        v1_charge_functions[result["_source"]["account_id"]] = result["_source"][
+            "v1_charge_function"
+        ]
+    return v1_charge_functions
+
+
+def get_v1_charges_query(accounts):
+    """Matches charge records that have not been converted yet, so
+    re-running the conversion only picks up where it left off"""
+    return {
+        "bool": {
+            "filter": [{"terms": {"account_id": accounts}}],
+            "must_not": [{"exists": {"field": "cas_version"}}],
+        }
+    }
+
+
+def load_state(state_file):
+    if not state_file.exists():
+        return {}
+    with state_file.open() as f:
+        return json.load(f)
+
+
+def save_state(state_file, state):
+    tmp_file = state_file.with_name(f"{state_file.name}.tmp")
+    with tmp_file.open("w") as f:
+        json.dump(state, f, indent=2)
+    tmp_file.replace(state_file)
+
+
+def wait_for_task(es, task_id, poll_interval):
+    """Polls an update_by_query task until it completes, printing progress"""
+    while True:
+        task = es.tasks.get(task_id=task_id)
+        status = task["task"]["status"]
+        click.echo(
+            f"{task_id}: {status['updated']} of {status['total']} charge records converted "
+            f"({status['noops']} skipped, {status['version_conflicts']} conflicts, "
+            f"throttled {status['requests_per_second']}/s)"
+        )
+        if task.get("completed", False):
+            return task
+        time.sleep(poll_interval)
+
+
+@click.command()
+@click.option("--dry_run", default=False, is_flag=True)
+@click.option(
+    "--account_index", envvar="CAS_ACCOUNT_INDEX", default="cas-credit-accounts"
+)
+@click.option(
+    "--charge_index", envvar="CAS_CHARGE_INDEX", default="cas-daily-charge-records-*"
+)
+@click.option(
+    "--requests_per_second",
+    default=-1.0,
+    type=float,
+    help="Throttle for the conversion, -1 for no throttling",
+)
+@click.option("--slices", default="auto", help="Number of parallel slices, or 'auto'")
+@click.option("--scroll_size", default=1000, type=int)
+@click.option("--poll_interval", default=10, type=int)
+@click.option(
+    "--state_file",
+    default=Path("./convert-charges-v1-to-v2-state.json"),
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Records the running conversion task so that it can be resumed",
+)
+@click.option("--es_host", envvar="ES_HOST", default="localhost")
+@click.option("--es_user", envvar="ES_USER")
+@click.option("--es_pass", envvar="ES_PASS")
+@click.option(
+    "--es_use_https/--es_no_use_https",
+    envvar="ES_USE_HTTPS",
+    type=click.BOOL,
+    default=False,
+)
+@click.option("--es_ca_certs", envvar="ES_CA_CERTS", type=click.Path(exists=True))
+def main(
+    dry_run,
+    account_index,
+    charge_index,
+    requests_per_second,
+    slices,
+    scroll_size,
+    poll_interval,
+    state_file,
+    es_host,
+    es_user,
+    es_pass,
+    es_use_https,
+    es_ca_certs,
+):
+    es = connect(es_host, es_user, es_pass, es_use_https, es_ca_certs)
+
+    # 1. Reattach to a conversion that was interrupted while running
+    state = load_state(state_file)
+    if state.get("task_id") is not None:
+        click.echo(f"Resuming conversion task {state['task_id']}")
+        wait_for_task(es, state["task_id"], poll_interval)
+        state["task_id"] = None
+        save_state(state_file, state)
+
+    # 2. Get charge functions of v1 accounts
+    v1_charge_functions = get_v1_charge_functions(es, account_index)
+    if len(v1_charge_functions) == 0:
+        click.echo(f"No v1 accounts found in index '{account_index}'")
+        return
+    query = get_v1_charges_query(list(v1_charge_functions))
+
+    n_charges = es.count(index=charge_index, body={"query": query})["count"]
+    click.echo(
+        f"{n_charges} v1 charge records from {len(v1_charge_functions)} accounts left to convert in '{charge_index}'"
+    )
+    if n_charges == 0 or dry_run:
+        return
+
+    # 3. Convert charge records in place
+    result = es.update_by_query(
+        index=charge_index,
+        body={
+            "query": query,
+            "script": {
+                "source": CONVERT_CHARGE_SCRIPT,
+                "lang": "painless",
+                "params": {"charge_functions": v1_charge_functions},
+            },
+        },
+        conflicts="proceed",
+        requests_per_second=requests_per_second,
+        slices=slices,
+        scroll_size=scroll_size,
+        refresh=True,
+        wait_for_completion=False,
+    )
+    state["task_id"] = result["task"]
+    save_state(state_file, state)
+
+    task = wait_for_task(es, state["task_id"], poll_interval)
+    state["task_id"] = None
+    save_state(state_file, state)
+
+    failures = task.get("response", {}).get("failures", [])
+    if task.get("error") is not None or len(failures) > 0:
+        click.echo(f"ERROR: Conversion task failed: {task.get('error', failures)}")
+        click.echo("Run again to convert the remaining charge records")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,12 @@ from elasticsearch.helpers import bulk
 from cas_admin.connect import connect
 from cas_admin.query_utils import (
     query_account,
-    get_charge_data,
     get_account_data,
-    get_usage_data,
+    get_charge_totals,
+    iter_charge_data,
+    iter_usage_data,
 )
-import cas_admin.cost_functions as cost_functions
+from cas_admin.usage import USAGE_BATCH_SIZE, add_usage_batch_charges
 
 
 START = date(2022, 2, 20)
@@ -59,7 +60,7 @@ def compute_missing_daily_charges(
         }
 
         # Get existing charge data
-        for charge_data in get_charge_data(
+        for charge_data in iter_charge_data(
             es_client,
             start_date=date,
             end_date=date + timedelta(days=1),
@@ -76,9 +77,10 @@ def compute_missing_daily_charges(
                 "total_charges"
             ]
 
-        # Get missing charge data
+        # Get missing charge data, charging job ads in batches
         match_terms = {account_name_attr: account}
-        for usage_row in get_usage_data(
+        missing_usage_rows = []
+        for usage_row in iter_usage_data(
             es_client,
             date,
             date + timedelta(days=1),
@@ -89,23 +91,15 @@ def compute_missing_daily_charges(
             if job_type == v1_account_type:
                 # We already should have this from existing charge data
                 continue
-
-            cost_function = getattr(cost_functions, cost_funcname[job_type])
-
-            user = f"{usage_row.get('Owner', 'UNKNOWN')}@{usage_row.get('ScheddName', 'UNKNOWN')}"
-            user_charges = account_charges[job_type].get(user, {})
-
-            resource_charges = cost_function(usage_row)
-            for resource_name, resource_charge in resource_charges.items():
-                if resource_charge < 0:
-                    click.echo(
-                        f"WARNING: Negative cost computed for account {account} with usage from following job ad, ignoring:\n{usage_row}",
-                        err=True,
-                    )
-                user_charges[resource_name] = (
-                    user_charges.get(resource_name, 0.0) + resource_charge
+            missing_usage_rows.append(usage_row)
+            if len(missing_usage_rows) >= USAGE_BATCH_SIZE:
+                add_usage_batch_charges(
+                    account, account_charges, cost_funcname, missing_usage_rows
                 )
-            account_charges[job_type][user] = user_charges
+                missing_usage_rows = []
+        add_usage_batch_charges(
+            account, account_charges, cost_funcname, missing_usage_rows
+        )
 
         # Create charge docs
         account_charge_docs = []
@@ -165,7 +159,7 @@ def apply_missing_daily_charges(
     for account_info in get_account_data(es_client, index=account_index):
         account_infos[account_info["account_id"]] = account_info
 
-    charge_data = get_charge_data(
+    charge_totals = get_charge_totals(
         es_client,
         date,
         date + timedelta(days=1),
@@ -174,9 +168,7 @@ def apply_missing_daily_charges(
     )
 
     updated_accounts = {}
-    for charge_info in charge_data:
-        account = charge_info["account_id"]
-        charge_type = charge_info["charge_type"]
+    for account, account_charge_totals in charge_totals.items():
         if account not in account_infos:
             click.echo(
                 f"WARNING: No account '{account}' found in index '{account_index}', skipping applying charges",
@@ -184,19 +176,18 @@ def apply_missing_daily_charges(
             )
             continue
 
-        # Skip applying existing charges
         v1_account_type = account_infos[account]["v1_charge_function"][0:3]
-        if charge_type == v1_account_type:
-            continue
+        for charge_type, total_charges in account_charge_totals.items():
+            # Skip applying existing charges
+            if charge_type == v1_account_type:
+                continue
 
-        if account not in updated_accounts:
-            updated_accounts[account] = account_infos[account]
-        if f"{charge_type}_charges" not in updated_accounts[account]:
-            updated_accounts[account][f"{charge_type}_charges"] = 0.0
-        updated_accounts[account][f"{charge_type}_charges"] += charge_info[
-            "total_charges"
-        ]
-        updated_accounts[account][f"{charge_type}_last_charge_date"] = str(date)
+            if account not in updated_accounts:
+                updated_accounts[account] = account_infos[account]
+            if f"{charge_type}_charges" not in updated_accounts[account]:
+                updated_accounts[account][f"{charge_type}_charges"] = 0.0
+            updated_accounts[account][f"{charge_type}_charges"] += total_charges
+            updated_accounts[account][f"{charge_type}_last_charge_date"] = str(date)
 
     updated_account_docs = []
     for account, updated_account in updated_accounts.items():
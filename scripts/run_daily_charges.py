@@ -1,52 +1,59 @@
 import click
 import sys
-import json
 from pathlib import Path
 from datetime import date, timedelta
 from cas_admin.connect import connect
-from cas_admin.usage import compute_daily_charges, apply_daily_charges
-from cas_admin.query_utils import query_account
+from cas_admin.bulk_utils import BulkWriter
+from cas_admin.account_cache import AccountCache
+from cas_admin.snapshots import SnapshotStore
+from cas_admin.usage import (
+    CHARGE_ENGINES,
+    compute_daily_charges,
+    compute_charges_for_dates,
+    apply_daily_charges,
+)
 
 START = date(2022, 2, 20)
 YESTERDAY = date.today() - timedelta(days=1)
 
 
-def snapshot_accounts(es_client, index, snapshot_dir, this_date, dry_run=False):
+def snapshot_accounts(account_cache, snapshot_store, this_date, dry_run=False):
     """Create a backup of account data from previous day.
     Do not allow backups to be overwritten."""
-    account_data = query_account(es_client, index=index)
-    if len(account_data["hits"]["hits"]) == 0:
+    # Re-read the index so the backup includes changes made outside this run
+    account_cache.invalidate()
+    account_hits = account_cache.hits()
+    index = account_cache.index
+    if len(account_hits) == 0:
         click.echo(f"ERROR: No account data found in index '{index}'")
         sys.exit(1)
-    snapshot_file = snapshot_dir / f"cas-credit-accounts_{this_date}.json"
-    if snapshot_file.exists():
+    if this_date in snapshot_store:
         click.echo(f"ERROR: Snapshot already exists for date '{this_date}'")
         sys.exit(1)
     if not dry_run:
-        with snapshot_file.open("w") as f:
-            json.dump(account_data["hits"]["hits"], f, indent=2)
+        snapshot_store.write(this_date, account_hits)
     else:
         click.echo(
-            f"Dry run, not writing {len(account_data['hits']['hits'])} account records to {snapshot_file}"
+            f"Dry run, not writing {len(account_hits)} account records to {snapshot_store.snapshot_dir}"
         )
 
 
-def get_missing_snapshot_dates(snapshot_dir):
+def get_missing_snapshot_dates(snapshot_store):
     """Count up the days since START in order so that we
     can make sure a snapshot is made (in order) since START"""
+    snapshot_dates = set(snapshot_store.dates())
     missing_snapshots = []
     n_days = (YESTERDAY - START).days
     for n_day in range(n_days + 1):
         this_date = START + timedelta(days=n_day)
-        snapshot_file = snapshot_dir / f"cas-credit-accounts_{this_date}.json"
-        if not snapshot_file.exists():
+        if this_date not in snapshot_dates:
             if (
                 len(missing_snapshots) > 0
                 and (this_date - missing_snapshots[-1]).days > 1
             ):
                 click.echo(
-                    """CRITICAL: Snapshot(s) exist between {missing_snapshots[-1]} and {this_date}, 
-cannot continue until {missing_snapshot[-1]} exists."""
+                    f"""CRITICAL: Snapshot(s) exist between {missing_snapshots[-1]} and {this_date}, 
+cannot continue until {missing_snapshots[-1]} exists."""
                 )
                 sys.exit(1)
             missing_snapshots.append(this_date)
@@ -55,7 +62,19 @@ cannot continue until {missing_snapshot[-1]} exists."""
 
 @click.command()
 @click.option("--dry_run", default=False, is_flag=True)
+@click.option(
+    "--backfill",
+    default=False,
+    is_flag=True,
+    help="Compute all missing days' charges from a single scan of job ads (--engine is ignored)",
+)
 @click.option("--override_end_date", default=False, is_flag=True)
+@click.option(
+    "--compact_snapshots",
+    default=False,
+    is_flag=True,
+    help="Rewrite existing account snapshots as compressed bases and deltas first",
+)
 @click.option(
     "--snapshot_dir",
     envvar="CAS_CREDIT_ACCOUNTS_SNAPSHOTS_DIR",
@@ -79,6 +98,21 @@ cannot continue until {missing_snapshot[-1]} exists."""
     envvar="CAS_ACCOUNT_NAME_ATTR",
     default="ProjectName",
 )
+@click.option(
+    "--engine",
+    envvar="CAS_CHARGE_ENGINE",
+    default="per_account",
+    type=click.Choice(CHARGE_ENGINES),
+    help="The composite engine is approximate (see compute_daily_charges)",
+)
+@click.option("--scan_slices", envvar="CAS_SCAN_SLICES", default=1, type=int)
+@click.option("--bulk_chunk_size", envvar="CAS_BULK_CHUNK_SIZE", default=500, type=int)
+@click.option(
+    "--bulk_max_chunk_bytes",
+    envvar="CAS_BULK_MAX_CHUNK_BYTES",
+    default=10 * 1024 * 1024,
+    type=int,
+)
 @click.option("--es_host", envvar="ES_HOST", default="localhost")
 @click.option("--es_user", envvar="ES_USER")
 @click.option("--es_pass", envvar="ES_PASS")
@@ -91,13 +125,19 @@ cannot continue until {missing_snapshot[-1]} exists."""
 @click.option("--es_ca_certs", envvar="ES_CA_CERTS", type=click.Path(exists=True))
 def main(
     dry_run,
+    backfill,
     override_end_date,
+    compact_snapshots,
     snapshot_dir,
     account_index,
     usage_index,
     charge_index,
     resource_name_attr,
     account_name_attr,
+    engine,
+    scan_slices,
+    bulk_chunk_size,
+    bulk_max_chunk_bytes,
     es_host,
     es_user,
     es_pass,
@@ -108,30 +148,69 @@ def main(
         global YESTERDAY
         YESTERDAY = date.today()
 
-    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    # A dry run must not adopt existing snapshots into a manifest or
+    # build the account index, so it only reads snapshot_dir
+    if not dry_run:
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_store = SnapshotStore(snapshot_dir, read_only=dry_run)
+    if compact_snapshots and not dry_run:
+        snapshot_store.compact()
 
     es_client = connect(es_host, es_user, es_pass, es_use_https, es_ca_certs)
+    writer = BulkWriter(
+        es_client, chunk_size=bulk_chunk_size, max_chunk_bytes=bulk_max_chunk_bytes
+    )
+    account_cache = AccountCache(es_client, account_index)
 
-    for missing_snapshot_date in get_missing_snapshot_dates(snapshot_dir):
-        compute_daily_charges(
+    missing_snapshot_dates = get_missing_snapshot_dates(snapshot_store)
+    backfill = backfill and len(missing_snapshot_dates) > 1
+    if backfill and engine != "per_account":
+        click.echo(
+            f"WARNING: Ignoring --engine {engine}, backfilling scans each job ad",
+            err=True,
+        )
+
+    # Compute all missing charges up front in one pass when backfilling,
+    # they are still applied and snapshotted one day at a time below
+    if backfill:
+        compute_charges_for_dates(
             es_client,
-            missing_snapshot_date,
+            missing_snapshot_dates,
             account_index,
             usage_index,
             charge_index,
             account_name_attr,
             dry_run,
+            scan_slices,
+            writer,
+            account_cache,
         )
+
+    for missing_snapshot_date in missing_snapshot_dates:
+        if not backfill:
+            compute_daily_charges(
+                es_client,
+                missing_snapshot_date,
+                account_index,
+                usage_index,
+                charge_index,
+                account_name_attr,
+                dry_run,
+                engine,
+                scan_slices,
+                writer,
+                account_cache,
+            )
         apply_daily_charges(
             es_client,
             missing_snapshot_date,
             account_index,
             charge_index,
             dry_run,
+            writer,
+            account_cache,
         )
-        snapshot_accounts(
-            es_client, account_index, snapshot_dir, missing_snapshot_date, dry_run
-        )
+        snapshot_accounts(account_cache, snapshot_store, missing_snapshot_date, dry_run)
 
 
 if __name__ == "__main__":
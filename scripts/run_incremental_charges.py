@@ -0,0 +1,78 @@
+import click
+from pathlib import Path
+from datetime import date
+from cas_admin.connect import connect
+from cas_admin.usage import compute_incremental_charges
+
+
+@click.command()
+@click.option("--dry_run", default=False, is_flag=True)
+@click.option(
+    "--watermark_file",
+    envvar="CAS_INCREMENTAL_WATERMARK_FILE",
+    default=Path("./cas-incremental-charges-watermarks.json"),
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+@click.option(
+    "--account_index", envvar="CAS_ACCOUNT_INDEX", default="cas-credit-accounts"
+)
+@click.option("--usage_index", envvar="CAS_USAGE_INDEX", default="path-schedd-*")
+@click.option(
+    "--charge_index", envvar="CAS_CHARGE_INDEX", default="cas-daily-charge-records"
+)
+@click.option(
+    "--account_name_attr",
+    envvar="CAS_ACCOUNT_NAME_ATTR",
+    default="ProjectName",
+)
+@click.option("--scan_slices", envvar="CAS_SCAN_SLICES", default=1, type=int)
+@click.option("--es_host", envvar="ES_HOST", default="localhost")
+@click.option("--es_user", envvar="ES_USER")
+@click.option("--es_pass", envvar="ES_PASS")
+@click.option(
+    "--es_use_https/--es_no_use_https",
+    envvar="ES_USE_HTTPS",
+    type=click.BOOL,
+    default=False,
+)
+@click.option("--es_ca_certs", envvar="ES_CA_CERTS", type=click.Path(exists=True))
+def main(
+    dry_run,
+    watermark_file,
+    account_index,
+    usage_index,
+    charge_index,
+    account_name_attr,
+    scan_slices,
+    es_host,
+    es_user,
+    es_pass,
+    es_use_https,
+    es_ca_certs,
+):
+    """Adds today's charges from job ads recorded since the last run.
+    Yesterday's charges are recomputed in full by run_daily_charges.py.
+
+    Job ads are picked up by RecordTime, so ads indexed late with a
+    RecordTime before the last run's are only charged when
+    run_daily_charges.py recomputes the day."""
+
+    watermark_file.parent.mkdir(parents=True, exist_ok=True)
+
+    es_client = connect(es_host, es_user, es_pass, es_use_https, es_ca_certs)
+
+    compute_incremental_charges(
+        es_client,
+        date.today(),
+        watermark_file,
+        account_index,
+        usage_index,
+        charge_index,
+        account_name_attr,
+        dry_run,
+        scan_slices,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,9 @@ import click
 from pathlib import Path
 from datetime import date, timedelta
 from cas_admin.connect import connect
-from cas_admin.email_utils import send_email, generate_weekly_account_owner_report
-from cas_admin.query_utils import get_account_emails
+from cas_admin.email_utils import send_email, generate_weekly_account_owner_reports
+from cas_admin.account_cache import AccountCache
+from cas_admin.mail_sender import MailSender, DirectMailSender
 
 IS_MONTHLY = date.today().day <= 7
 
@@ -34,9 +35,30 @@ IS_MONTHLY = date.today().day <= 7
     type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path),
     default=None,
 )
+@click.option(
+    "--smtp_pool_size",
+    envvar="CAS_SMTP_POOL_SIZE",
+    default=4,
+    type=int,
+    help="Number of SMTP connections to send with concurrently",
+)
+@click.option(
+    "--smtp_rate_limit",
+    envvar="CAS_SMTP_RATE_LIMIT",
+    default=None,
+    type=float,
+    help="Maximum number of emails to send per second",
+)
 @click.option("--no_email_owners", "no_email_owners", is_flag=True)
 @click.option("--account", "account_ids", multiple=True, default=[])
 @click.option("--force", "force_send", is_flag=True)
+@click.option(
+    "--processes",
+    envvar="CAS_REPORT_PROCESSES",
+    default=1,
+    type=int,
+    help="Number of processes to render reports with",
+)
 @click.option(
     "--account_index", envvar="CAS_ACCOUNT_INDEX", default="cas-credit-accounts"
 )
@@ -74,40 +96,64 @@ def main(
     smtp_server,
     smtp_username,
     smtp_password_file,
+    smtp_pool_size,
+    smtp_rate_limit,
     no_email_owners,
     account_ids,
     force_send,
+    processes,
 ):
     es_client = connect(es_host, es_user, es_pass, es_use_https, es_ca_certs)
 
     errors = []
     last_week = date.today() - timedelta(days=7)
-    active_accounts = get_account_emails(es_client, last_week, account_index)
+    account_cache = AccountCache(es_client, account_index)
+    active_accounts = account_cache.get_account_emails(last_week)
+
+    # Share SMTP connections across all emails
+    sender = DirectMailSender()
+    if smtp_server is not None:
+        smtp_password = None
+        if smtp_password_file is not None:
+            smtp_password = smtp_password_file.open("r").read().strip()
+        sender = MailSender(
+            smtp_server,
+            smtp_username,
+            smtp_password,
+            pool_size=smtp_pool_size,
+            rate_limit=smtp_rate_limit,
+        )
+    sent_futures = {}
 
     # Send weekly account report to owners
     subject_tmpl = f"{date.today()} PATh Credit Account Owner Report"
-    for account_id, owner_email in get_account_emails(
-        es_client, index=account_index
-    ).items():
-        if len(account_ids) > 0 and account_id not in account_ids:
-            continue
+    owner_emails = account_cache.get_account_emails()
+    report_accounts = [
+        account_id
+        for account_id in owner_emails
+        if len(account_ids) == 0 or account_id in account_ids
+    ]
+    for account_id, attachments, error in generate_weekly_account_owner_reports(
+        es_client,
+        last_week,
+        report_accounts,
+        xlsx_directory,
+        snapshot_directory,
+        account_index,
+        charge_index,
+        account_cache,
+        processes,
+    ):
         subject = f"{subject_tmpl} for {account_id}"
         all_to_addrs = list(to_addrs)
         if not no_email_owners:
-            all_to_addrs.append(owner_email)
+            all_to_addrs.append(owner_emails[account_id])
         try:
-            attachments = generate_weekly_account_owner_report(
-                es_client,
-                account_id,
-                last_week,
-                xlsx_directory,
-                snapshot_directory,
-                account_index,
-                charge_index,
-            )
+            if error is not None:
+                raise error
             html = attachments.pop("html")
             if force_send or IS_MONTHLY or account_id in active_accounts:
-                send_email(
+                sent_futures[subject] = send_email(
                     from_addr,
                     list(all_to_addrs),
                     subject,
@@ -117,12 +163,21 @@ def main(
                     smtp_server=smtp_server,
                     smtp_username=smtp_username,
                     smtp_password_file=smtp_password_file,
+                    sender=sender,
                 )
         except Exception as e:
             error_str = f"Error while sending '{subject}':\n\t{str(e)}"
             click.echo(error_str, err=True)
             errors.append(error_str.replace("\n", "<br>"))
 
+    # Wait for queued emails, including retries
+    sender.close()
+    for sent_subject, sent_future in sent_futures.items():
+        if sent_future is not None and not sent_future.result():
+            error_str = f"Error while sending '{sent_subject}':\n\tCould not send email to all recipients"
+            click.echo(error_str, err=True)
+            errors.append(error_str.replace("\n", "<br>"))
+
     # Send email with errors to admins
     if len(errors) > 0:
         error_html = f"<html><body>{'<br><br>'.join(errors)}</body></html>"
@@ -5,7 +5,15 @@ setup(
     version="2.0.0",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["click", "elasticsearch<8.0.0", "dnspython", "XlsxWriter<=3.2.2"],
+    install_requires=[
+        "click",
+        # Account listing uses point-in-time searches sorted on _shard_doc,
+        # which need an Elasticsearch 7.12+ client and server
+        "elasticsearch>=7.12.0,<8.0.0",
+        "dnspython>=2.0",
+        "XlsxWriter<=3.2.2",
+    ],
+    extras_require={"numpy": ["numpy"]},
     entry_points={
         "console_scripts": [
             "cas_admin = cas_admin.cli:cli",
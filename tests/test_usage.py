@@ -0,0 +1,251 @@
+import random
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import cas_admin.cost_functions as cost_functions
+import cas_admin.query_utils as query_utils
+from cas_admin.usage import (
+    UsageBatches,
+    compute_daily_charges,
+    compute_charges_for_dates,
+    compute_incremental_charges,
+)
+
+
+DATE = date(2024, 1, 1)
+ACCOUNTS = {
+    account: {"cpu_charge_function": "cpu_2022", "gpu_charge_function": "gpu_2022"}
+    for account in ["account_a", "account_b"]
+}
+
+
+def make_ads(n_ads=2000, seed=0, dates=[DATE]):
+    rng = random.Random(seed)
+    start_ts = datetime(dates[0].year, dates[0].month, dates[0].day).timestamp()
+    ads = []
+    for i in range(n_ads):
+        ad = {
+            "RecordTime": int(start_ts + rng.uniform(0, 86400 * len(dates))),
+            "ProjectName": rng.choice(list(ACCOUNTS)),
+            "Owner": rng.choice(["alice", "bob", "carol"]),
+            "ScheddName": rng.choice(["ap1", "ap2"]),
+            "RequestCpus": rng.choice([1, 2, 4, 8, 16, 40, 64]),
+            "RequestMemory": rng.choice([512, 2048, 8192, 65536, 300000]),
+            "RequestGpus": rng.choice([0, 0, 1, 2, 4]),
+            "IsHyperthreadCpu": rng.choice([True, False]),
+            "RemoteWallClockTime": rng.uniform(0, 86400),
+        }
+        # Some ads lack optional attributes
+        if rng.random() < 0.1:
+            ad.pop("IsHyperthreadCpu")
+        if rng.random() < 0.1:
+            ad.pop("RequestGpus")
+        ads.append(ad)
+    return ads
+
+
+def matches(ad, filters):
+    for query_filter in filters:
+        if "match_phrase" in query_filter:
+            for attr, value in query_filter["match_phrase"].items():
+                if ad.get(attr) != value:
+                    return False
+        if "terms" in query_filter:
+            for attr, values in query_filter["terms"].items():
+                if ad.get(attr) not in values:
+                    return False
+        if "range" in query_filter:
+            for attr, bounds in query_filter["range"].items():
+                if not bounds["gte"] <= ad[attr] < bounds["lt"]:
+                    return False
+    return True
+
+
+class FakeES:
+    """Answers usage scans and composite aggregations from a list of ads"""
+
+    def __init__(self, ads):
+        self.ads = ads
+
+    def scan(self, client, query, index, scroll=None, size=None):
+        filters = query["query"]["bool"]["filter"]
+        for ad in self.ads:
+            if matches(ad, filters):
+                source = {col: ad[col] for col in query["_source"] if col in ad}
+                yield {"_index": "usage", "_source": source}
+
+    def search(self, index, body, size=0):
+        filters = body["query"]["bool"]["filter"]
+        composite = body["aggs"]["buckets"]["composite"]
+        group_cols = [list(source)[0] for source in composite["sources"]]
+        (sum_col,) = body["aggs"]["buckets"]["aggs"]
+        buckets = {}
+        for ad in self.ads:
+            if not matches(ad, filters):
+                continue
+            key = tuple(ad.get(col) for col in group_cols)
+            bucket = buckets.setdefault(key, {"doc_count": 0, "sum": 0.0})
+            bucket["doc_count"] += 1
+            bucket["sum"] += ad.get(sum_col, 0)
+        return {
+            "aggregations": {
+                "buckets": {
+                    "buckets": [
+                        {
+                            "key": dict(zip(group_cols, key)),
+                            "doc_count": bucket["doc_count"],
+                            sum_col: {"value": bucket["sum"]},
+                        }
+                        for key, bucket in buckets.items()
+                    ]
+                }
+            }
+        }
+
+
+class FakeAccountCache:
+    def get_account_data(self):
+        return [dict(info, account_id=account) for account, info in ACCOUNTS.items()]
+
+
+class FakeWriter:
+    def __init__(self):
+        self.charges = {}
+
+    def add(self, account, action):
+        self.charges[action["_id"]] = action["_source"]["total_charges"]
+
+    def close(self):
+        return len(self.charges), {}
+
+
+def compute_charges(es, engine, this_date=DATE):
+    writer = FakeWriter()
+    compute_daily_charges(
+        es,
+        this_date,
+        engine=engine,
+        writer=writer,
+        account_cache=FakeAccountCache(),
+    )
+    return writer.charges
+
+
+@pytest.mark.parametrize("use_batch", [True, False])
+@pytest.mark.parametrize("engine", ["per_account", "single_scan"])
+def test_composite_engine_matches_per_ad_engines(monkeypatch, engine, use_batch):
+    if not use_batch:
+        monkeypatch.delattr(cost_functions.cpu_2022, "batch", raising=False)
+        monkeypatch.delattr(cost_functions.gpu_2022, "batch", raising=False)
+    es = FakeES(make_ads())
+    monkeypatch.setattr(query_utils, "scan", es.scan)
+
+    per_ad_charges = compute_charges(es, engine)
+    composite_charges = compute_charges(es, "composite")
+
+    # Both cost functions and all of their resources were charged
+    charged = {tuple(doc_id.split("#")[3:]) for doc_id in per_ad_charges}
+    assert charged >= {
+        ("cpu", "cpu"),
+        ("cpu", "memory"),
+        ("gpu", "gpu"),
+        ("gpu", "cpu"),
+        ("gpu", "memory"),
+    }
+
+    assert set(composite_charges) == set(per_ad_charges)
+    for doc_id, charge in per_ad_charges.items():
+        assert composite_charges[doc_id] == pytest.approx(charge, rel=1e-9, abs=1e-9)
+
+
+def test_usage_batches_hold_at_most_max_rows():
+    batches = []
+    usage_batches = UsageBatches(
+        lambda key, rows: batches.append((key, len(rows))), max_rows=10
+    )
+    for i in range(95):
+        usage_batches.add(f"account_{i % 7}", {"i": i})
+        assert usage_batches.n_rows < 10
+    usage_batches.flush("account_0")
+    assert "account_0" not in usage_batches.rows
+    usage_batches.flush()
+
+    assert usage_batches.n_rows == 0
+    for i in range(7):
+        assert sum(n for key, n in batches if key == f"account_{i}") == len(
+            range(i, 95, 7)
+        )
+
+
+def test_backfill_matches_daily_charges(monkeypatch):
+    dates = [DATE + timedelta(days=i) for i in range(3)]
+    es = FakeES(make_ads(dates=dates))
+    monkeypatch.setattr(query_utils, "scan", es.scan)
+
+    daily_charges = {}
+    for this_date in dates:
+        daily_charges.update(compute_charges(es, "per_account", this_date))
+
+    writer = FakeWriter()
+    compute_charges_for_dates(
+        es, dates, writer=writer, account_cache=FakeAccountCache()
+    )
+
+    assert set(writer.charges) == set(daily_charges)
+    for doc_id, charge in daily_charges.items():
+        assert writer.charges[doc_id] == pytest.approx(charge, rel=1e-9, abs=1e-9)
+
+
+class FakeChargeIndex:
+    """Applies incremental charge updates, failing the given doc ids"""
+
+    def __init__(self, charges, fail_doc_ids=()):
+        self.charges = charges
+        self.fail_doc_ids = set(fail_doc_ids)
+        self.errors = {}
+
+    def add(self, account, action):
+        doc_id = action["_id"]
+        if doc_id in self.fail_doc_ids:
+            self.errors.setdefault(account, []).append(
+                {"update": {"_id": doc_id, "status": 429}}
+            )
+        elif doc_id in self.charges:
+            self.charges[doc_id] += action["script"]["params"]["total_charges"]
+        else:
+            self.charges[doc_id] = action["upsert"]["total_charges"]
+
+    def close(self):
+        return len(self.charges), self.errors
+
+
+def test_incremental_rerun_does_not_double_count(monkeypatch, tmp_path):
+    es = FakeES(make_ads())
+    monkeypatch.setattr(query_utils, "scan", es.scan)
+    watermark_file = tmp_path / "watermarks.json"
+    daily_charges = compute_charges(es, "per_account")
+
+    charges = {}
+    failed_doc_id = sorted(daily_charges)[0]
+    with pytest.raises(SystemExit):
+        compute_incremental_charges(
+            es,
+            DATE,
+            watermark_file,
+            writer=FakeChargeIndex(charges, [failed_doc_id]),
+            account_cache=FakeAccountCache(),
+        )
+    assert failed_doc_id not in charges
+
+    compute_incremental_charges(
+        es,
+        DATE,
+        watermark_file,
+        writer=FakeChargeIndex(charges),
+        account_cache=FakeAccountCache(),
+    )
+
+    assert set(charges) == set(daily_charges)
+    for doc_id, charge in daily_charges.items():
+        assert charges[doc_id] == pytest.approx(charge, rel=1e-9, abs=1e-9)